@@ -0,0 +1,269 @@
+import os
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, func, or_, select, tuple_
+from .config import db
+from .models import PortfolioSnapshots, Portfolios, Transactions
+from .encryption_utils import monetary_crypto
+from .categories import category_registry
+from .cache_utils import BoundedTTLCache
+
+# ?granularity= -> pandas frequency; weeks end on Sunday, months on their last day
+GRANULARITIES = {"day": "D", "week": "W-SUN", "month": "ME"}
+
+# "transactions" replays the whole log; "snapshots" reads the daily balance
+# snapshots (run `flask rebuild-snapshots` before switching)
+TIMESERIES_SOURCE = os.environ.get('TIMESERIES_SOURCE', 'transactions')
+
+# user_id -> (data_version, cash-flow payload); an entry built for an older
+# data version is never served
+cashflow_cache = BoundedTTLCache(
+    maxsize=int(os.environ.get('CASHFLOW_CACHE_SIZE', 1024))
+)
+
+
+def _flow_frame(category_ids, timestamps, amounts):
+    """DataFrame of flows indexed by timestamp: category_id, amount, category"""
+    frame = pd.DataFrame(
+        {"category_id": category_ids, "amount": amounts},
+        index=pd.DatetimeIndex(timestamps, name="timestamp"),
+    )
+    names = {
+        category_id: category_registry.get_names(category_id)[0]
+        for category_id in np.unique(category_ids).tolist()
+    }
+    frame["category"] = frame["category_id"].map(names).astype("category")
+    return frame.sort_index(kind="stable")
+
+
+def _decrypt_column(ciphertexts, count):
+    return np.fromiter(
+        monetary_crypto.decrypt_many(ciphertexts, memoize=False),
+        dtype=np.float64,
+        count=count,
+    )
+
+
+def _transaction_rows(user_id, category_names=None, end=None, tail_only=False):
+    """(category_id, timestamp, compact, legacy) rows of dated transactions"""
+    query = (
+        select(
+            Transactions.category_id,
+            Transactions.timestamp,
+            Transactions.amount_ciphertext,
+            Transactions.amount_encrypted,
+        )
+        .where(Transactions.user_id == user_id, Transactions.timestamp.isnot(None))
+    )
+    if tail_only:
+        query = query.outerjoin(Portfolios, and_(
+            Portfolios.user_id == Transactions.user_id,
+            Portfolios.category_id == Transactions.category_id,
+        )).where(
+            Transactions.id > func.coalesce(Portfolios.checkpoint_transaction_id, 0)
+        )
+    if category_names:
+        query = query.where(
+            Transactions.category_id.in_(category_registry.get_ids(category_names))
+        )
+    if end:
+        query = query.where(Transactions.timestamp < end + timedelta(days=1))
+    return db.session.execute(query).all()
+
+
+def load_transaction_frame(user_id, category_names=None, end=None):
+    """The user's dated transactions as a DataFrame indexed by timestamp
+
+    Columns are category_id, amount and category (name). Amounts are
+    decrypted in one batch without going through the memo.
+    """
+    rows = _transaction_rows(user_id, category_names, end)
+    return _flow_frame(
+        np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+        [row[1] for row in rows],
+        _decrypt_column((compact or legacy for _, _, compact, legacy in rows), len(rows)),
+    )
+
+
+def load_snapshot_frame(user_id, category_names=None, start=None, end=None):
+    """Same flows as load_transaction_frame(), read from the daily snapshots
+
+    Each snapshot becomes the change since the category's previous one, and
+    transactions not folded into snapshots yet are added as they are. With
+    start, the snapshots before it are reduced to the last one of each
+    category, so only the requested range is scanned.
+    """
+    conditions = [PortfolioSnapshots.user_id == user_id]
+    if category_names:
+        conditions.append(
+            PortfolioSnapshots.category_id.in_(category_registry.get_ids(category_names))
+        )
+    query = (
+        select(
+            PortfolioSnapshots.category_id,
+            PortfolioSnapshots.day,
+            PortfolioSnapshots.balance_ciphertext,
+        )
+        .where(*conditions)
+        .order_by(PortfolioSnapshots.category_id, PortfolioSnapshots.day)
+    )
+    if end:
+        query = query.where(PortfolioSnapshots.day <= end.date())
+    if start:
+        opening = (
+            select(PortfolioSnapshots.category_id, func.max(PortfolioSnapshots.day))
+            .where(*conditions, PortfolioSnapshots.day < start.date())
+            .group_by(PortfolioSnapshots.category_id)
+        )
+        query = query.where(or_(
+            PortfolioSnapshots.day >= start.date(),
+            tuple_(PortfolioSnapshots.category_id, PortfolioSnapshots.day).in_(opening),
+        ))
+    rows = db.session.execute(query).all()
+
+    category_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    balances = _decrypt_column((row[2] for row in rows), len(rows))
+    # Rows are ordered by category then day: a flow is the step between
+    # consecutive balances, the first one of a category is its balance
+    flows = np.diff(balances, prepend=0.0)
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = category_ids[1:] != category_ids[:-1]
+    flows[first] = balances[first]
+
+    tail = _transaction_rows(user_id, category_names, end, tail_only=True)
+    return _flow_frame(
+        np.concatenate([
+            category_ids,
+            np.fromiter((row[0] for row in tail), dtype=np.int64, count=len(tail)),
+        ]),
+        [pd.Timestamp(row[1]) for row in rows] + [row[1] for row in tail],
+        np.concatenate([
+            flows,
+            _decrypt_column((compact or legacy for _, _, compact, legacy in tail), len(tail)),
+        ]),
+    )
+
+
+def balance_timeseries(frame, granularity, start=None):
+    """Closing balance per category at the end of every period
+
+    Net flows are summed per (period, category), gaps are filled with zero
+    and a cumulative sum turns flows into balances. Flows before start
+    count as an opening balance on start. Returns a wide DataFrame: one row
+    per period, one column per category.
+    """
+    freq = GRANULARITIES[granularity]
+    if frame.empty:
+        return pd.DataFrame(dtype=np.float64)
+
+    if start:
+        frame = frame.set_axis(
+            frame.index.where(frame.index >= start, pd.Timestamp(start))
+        )
+
+    flows = (
+        frame.groupby([pd.Grouper(freq=freq), "category"], observed=True)["amount"]
+        .sum()
+        .unstack("category", fill_value=0.0)
+    )
+    # Regroup on the same frequency to insert the periods without any flow
+    flows = flows.resample(freq).sum()
+    return flows.cumsum().round(2)
+
+
+def timeseries_payload(balances):
+    """Columnar JSON: shared dates, then one list of values per series"""
+    if balances.empty:
+        return {"dates": [], "series": {}, "total": []}
+
+    return {
+        "dates": balances.index.strftime("%Y-%m-%d").tolist(),
+        "series": {
+            str(column): balances[column].tolist() for column in balances.columns
+        },
+        "total": balances.sum(axis=1).round(2).tolist(),
+    }
+
+
+CASHFLOW_MEASURES = ("deposits", "withdrawals", "net")
+
+
+def cashflow_matrix(frame):
+    """Deposits, withdrawals and net flow per month and category
+
+    Returns a DataFrame indexed by month start whose columns are
+    (measure, category) pairs; withdrawals are positive amounts. Months
+    without any transaction are included with zeros.
+    """
+    if frame.empty:
+        return pd.DataFrame(dtype=np.float64)
+
+    amounts = frame["amount"]
+    measures = pd.DataFrame({
+        "deposits": amounts.clip(lower=0),
+        "withdrawals": (-amounts).clip(lower=0),
+        "net": amounts,
+    }, index=frame.index)
+
+    matrix = (
+        measures.groupby([pd.Grouper(freq="MS"), frame["category"]], observed=True)
+        .sum()
+        .unstack("category", fill_value=0.0)
+    )
+    return matrix.resample("MS").sum().round(2)
+
+
+def cashflow_payload(matrix):
+    """Columnar JSON: months, then per category and in total one list per measure"""
+    if matrix.empty:
+        return {
+            "months": [],
+            "categories": {},
+            "totals": {measure: [] for measure in CASHFLOW_MEASURES},
+        }
+
+    categories = matrix.columns.get_level_values("category").unique()
+    return {
+        "months": matrix.index.strftime("%Y-%m").tolist(),
+        "categories": {
+            str(category): {
+                measure: matrix[measure, category].tolist()
+                for measure in CASHFLOW_MEASURES
+            }
+            for category in categories
+        },
+        "totals": {
+            measure: matrix[measure].sum(axis=1).round(2).tolist()
+            for measure in CASHFLOW_MEASURES
+        },
+    }
+
+
+def get_cashflow(user_id, data_version=None):
+    """Cached cash-flow payload of all the user's transactions"""
+    entry = cashflow_cache.get(user_id)
+    if entry is not None and data_version is not None and entry[0] == data_version:
+        return entry[1]
+
+    payload = cashflow_payload(cashflow_matrix(load_transaction_frame(user_id)))
+    if data_version is not None:
+        cashflow_cache.set(user_id, (data_version, payload))
+    return payload
+
+
+def filter_cashflow(payload, category_names):
+    """Restrict a cash-flow payload to some categories and recompute totals"""
+    categories = {
+        category_name: series
+        for category_name, series in payload["categories"].items()
+        if category_name in category_names
+    }
+    totals = {
+        measure: [
+            round(sum(values), 2)
+            for values in zip(*(series[measure] for series in categories.values()))
+        ] if categories else [0.0] * len(payload["months"])
+        for measure in CASHFLOW_MEASURES
+    }
+    return {"months": payload["months"], "categories": categories, "totals": totals}
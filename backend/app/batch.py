@@ -0,0 +1,145 @@
+import os
+import math
+from datetime import datetime
+from .config import db
+from .models import Transactions
+from .categories import category_registry
+from .portfolio import mark_portfolio_changed
+from .ledger import locked_balances, write_balances
+from .events import queue_balance_delta
+
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 100))
+
+OPERATIONS = ("invest", "withdraw", "delete_entry")
+
+
+def _parse_operation(operation):
+    """Validate one operation; returns (parsed, error_message)"""
+    if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+        return None, "Opération invalide"
+
+    if operation["op"] == "delete_entry":
+        try:
+            return {"op": "delete_entry", "entry_id": int(operation.get("entry_id"))}, None
+        except (ValueError, TypeError):
+            return None, "Identifiant d'entrée requis"
+
+    category_id = category_registry.get_id(
+        operation.get("categoryName"), operation.get("subCategory")
+    )
+    if category_id is None:
+        return None, "Cette combinaison de catégorie et de sous-catégorie n'existe pas"
+
+    try:
+        amount = round(float(operation.get("amount")), 2)
+    except (ValueError, TypeError):
+        return None, "Montant invalide"
+    # NaN and inf would be encrypted, then poison every balance they touch
+    if not math.isfinite(amount):
+        return None, "Montant invalide"
+    if not amount > 0:
+        return None, "Le montant doit être supérieur à zéro"
+
+    return {"op": operation["op"], "category_id": category_id, "amount": amount}, None
+
+
+def run_batch(user_id, operations):
+    """Apply invest / withdraw / delete_entry operations atomically
+
+    Operations are validated and played in order against the balances of
+    the touched Portfolios rows, which are locked once each. If every
+    operation succeeds, the new transactions are inserted, the deleted ones
+    removed and each touched balance re-encrypted once. Returns
+    (results, ok); when ok is False nothing was written and the caller
+    must roll back.
+    """
+    results = []
+    parsed = []
+    for index, operation in enumerate(operations):
+        entry, error = _parse_operation(operation)
+        op_name = operation.get("op") if isinstance(operation, dict) else None
+        results.append({"index": index, "op": op_name, "success": error is None})
+        if error:
+            results[-1]["message"] = error
+        parsed.append(entry)
+
+    # Load every transaction to delete in one query
+    entry_ids = [
+        entry["entry_id"] for entry in parsed if entry and entry["op"] == "delete_entry"
+    ]
+    deleted = {}
+    if entry_ids:
+        deleted = {
+            transaction.id: transaction
+            for transaction in Transactions.query.filter(
+                Transactions.id.in_(entry_ids), Transactions.user_id == user_id
+            )
+        }
+
+    category_ids = {
+        entry["category_id"] for entry in parsed if entry and "category_id" in entry
+    }
+    category_ids |= {transaction.category_id for transaction in deleted.values()}
+    portfolios, balances = locked_balances(user_id, category_ids)
+    initial_balances = dict(balances)
+
+    new_transactions = []
+    seen_deletes = set()
+    timestamp = datetime.utcnow()
+
+    for entry, result in zip(parsed, results):
+        if entry is None:
+            continue
+
+        if entry["op"] == "delete_entry":
+            transaction = deleted.get(entry["entry_id"])
+            if transaction is None or transaction.id in seen_deletes:
+                result.update(
+                    success=False,
+                    message="Transaction introuvable ou vous n'avez pas l'autorisation de la supprimer"
+                )
+                continue
+            seen_deletes.add(transaction.id)
+            balances[transaction.category_id] = round(
+                balances[transaction.category_id] - transaction.amount, 2
+            )
+            continue
+
+        category_id, amount = entry["category_id"], entry["amount"]
+        if entry["op"] == "withdraw":
+            if balances[category_id] < amount:
+                result.update(
+                    success=False, message="Solde insuffisant pour effectuer ce retrait"
+                )
+                continue
+            amount = -amount
+
+        balances[category_id] = round(balances[category_id] + amount, 2)
+        transaction = Transactions(
+            user_id=user_id, category_id=category_id, amount=amount, timestamp=timestamp
+        )
+        new_transactions.append(transaction)
+        result["transaction"] = transaction
+
+    ok = all(result["success"] for result in results)
+    if not ok:
+        for result in results:
+            result.pop("transaction", None)
+        return results, False
+
+    for transaction_id in seen_deletes:
+        db.session.delete(deleted[transaction_id])
+    db.session.add_all(new_transactions)
+    write_balances(
+        user_id, portfolios, balances,
+        deleted=[deleted[transaction_id] for transaction_id in seen_deletes]
+    )
+    for category_id, balance in balances.items():
+        queue_balance_delta(user_id, category_id, balance - initial_balances[category_id])
+    mark_portfolio_changed(user_id)
+
+    for result in results:
+        transaction = result.pop("transaction", None)
+        if transaction is not None:
+            result["id"] = transaction.id
+    return results, True
@@ -0,0 +1,77 @@
+import hashlib
+import json
+from types import MappingProxyType
+from .models import Categories
+from .helpers import serialize_category
+
+
+class CategoryRegistry:
+    """Read-only in-memory index of the Categories reference table
+
+    The table is only written when it is seeded, so it is loaded once and
+    served from memory. Call reload() after changing the table.
+    """
+
+    def __init__(self):
+        self._state = None
+
+    def reload(self):
+        """Load the table and swap in a new index"""
+        categories = Categories.query.order_by(Categories.id).all()
+
+        payload = {
+            "distinct_categories": list(dict.fromkeys(
+                category.category_name for category in categories
+            )),
+            "all_categories": [serialize_category(category) for category in categories],
+        }
+        etag = hashlib.sha256(
+            json.dumps(payload, sort_keys=True).encode()
+        ).hexdigest()[:32]
+
+        # A single attribute assignment, so readers see the old or the new index
+        self._state = (
+            MappingProxyType({
+                (category.category_name, category.sub_category): category.id
+                for category in categories
+            }),
+            MappingProxyType({
+                category.id: (category.category_name, category.sub_category)
+                for category in categories
+            }),
+            MappingProxyType(payload),
+            etag,
+        )
+
+    def _loaded_state(self):
+        if self._state is None:
+            self.reload()
+        return self._state
+
+    def get_id(self, category_name, sub_category):
+        """Return the id of a (category, sub-category) pair, or None"""
+        return self._loaded_state()[0].get((category_name, sub_category))
+
+    def get_names(self, category_id):
+        """Return (category_name, sub_category) for an id, or None"""
+        return self._loaded_state()[1].get(category_id)
+
+    def get_ids(self, category_names):
+        """Ids of every sub-category of the given categories"""
+        return [
+            category_id
+            for category_id, (category_name, _) in self._loaded_state()[1].items()
+            if category_name in category_names
+        ]
+
+    @property
+    def payload(self):
+        """Serialized category lists returned by GET /api/invest"""
+        return self._loaded_state()[2]
+
+    @property
+    def etag(self):
+        return self._loaded_state()[3]
+
+
+category_registry = CategoryRegistry()
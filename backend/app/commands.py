@@ -0,0 +1,429 @@
+import os
+import json
+import time
+import click
+from collections import deque
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import (
+    LargeBinary, Text, and_, bindparam, func, null, or_, select, tuple_, update
+)
+from .config import app, db
+from .models import (
+    Users, Portfolios, PortfolioSnapshots, RebalanceReports, Transactions
+)
+from .encryption_utils import monetary_crypto, reencrypt_amounts
+from .ledger import compact_ledger
+from .snapshots import closing_balance_rows, folded_transaction_rows, replace_snapshots
+from .rebalance import allocation_drift, decrypt_amounts, read_chunk, write_reports
+
+
+def _convert_legacy_rows(table, key_columns, legacy_column, compact_column, batch_size):
+    """Rewrite legacy ciphertexts of one table in keyset-ordered batches
+
+    Only rows still missing the compact value are selected, so an interrupted
+    run simply resumes where it stopped. The UPDATE is guarded on the compact
+    column being NULL so rows rewritten concurrently by the app are left alone.
+    """
+    key_tuple = tuple_(*key_columns)
+    statement = (
+        update(table)
+        .where(*[column == bindparam(f"key_{column.name}") for column in key_columns])
+        .where(compact_column.is_(None))
+        .values({compact_column.name: bindparam("ciphertext"), legacy_column.name: None})
+    )
+
+    last_key = None
+    converted = 0
+    started = time.perf_counter()
+
+    while True:
+        query = (
+            select(*key_columns, legacy_column)
+            # "" was the legacy column default: nothing to convert, it reads as 0
+            .where(compact_column.is_(None), legacy_column.isnot(None), legacy_column != "")
+            .order_by(*key_columns)
+            .limit(batch_size)
+        )
+        if last_key is not None:
+            query = query.where(key_tuple > last_key)
+
+        rows = db.session.execute(query).all()
+        if not rows:
+            break
+
+        parameters = []
+        for row in rows:
+            *key, legacy_value = row
+            parameters.append({
+                **{f"key_{column.name}": value for column, value in zip(key_columns, key)},
+                "ciphertext": monetary_crypto.encrypt_amount(
+                    monetary_crypto.decrypt_amount(legacy_value)
+                ),
+            })
+
+        db.session.execute(statement, parameters)
+        db.session.commit()
+
+        last_key = tuple(rows[-1][:len(key_columns)])
+        converted += len(rows)
+        elapsed = time.perf_counter() - started
+        print(f"{table.name}: {converted} rows converted ({converted / elapsed:.0f} rows/s)")
+
+    return converted
+
+
+@app.cli.command("migrate-amounts")
+@click.option("--batch-size", default=1000, show_default=True)
+def migrate_amounts(batch_size):
+    """Convert legacy encrypted amounts to the compact binary format"""
+    portfolios = Portfolios.__table__
+    transactions = Transactions.__table__
+
+    _convert_legacy_rows(
+        portfolios,
+        [portfolios.c.user_id, portfolios.c.category_id],
+        portfolios.c.balance_encrypted,
+        portfolios.c.balance_ciphertext,
+        batch_size,
+    )
+    _convert_legacy_rows(
+        transactions,
+        [transactions.c.id],
+        transactions.c.amount_encrypted,
+        transactions.c.amount_ciphertext,
+        batch_size,
+    )
+
+
+def _load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    # A checkpoint written for another primary key does not apply
+    if checkpoint.get("key_id") != monetary_crypto.key_id.hex():
+        return {}
+    return checkpoint
+
+
+def _save_checkpoint(path, checkpoint):
+    if not path:
+        return
+    checkpoint["key_id"] = monetary_crypto.key_id.hex()
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, default=date.isoformat)
+    os.replace(temporary_path, path)
+
+
+def _rotate_table(pool, table, key_columns, legacy_column, compact_column,
+                  batch_size, max_in_flight, checkpoint, checkpoint_path):
+    """Re-encrypt one table under the primary key, batches fanned out to pool
+
+    Rows are read in keyset order while earlier batches are being encrypted
+    in worker processes. Results are written back in submission order, so the
+    checkpoint always marks a prefix of the table that is fully rotated.
+    legacy_column is None for tables only ever written in the compact format.
+    """
+    key_tuple = tuple_(*key_columns)
+    statement = (
+        update(table)
+        .where(*[column == bindparam(f"key_{column.name}") for column in key_columns])
+        .where(compact_column.is_not_distinct_from(
+            bindparam("old_compact", type_=LargeBinary)
+        ))
+    )
+    # Skip rows already in the compact format under the primary key
+    pending = func.substr(compact_column, 2, 4) != monetary_crypto.key_id
+    if legacy_column is None:
+        statement = statement.values({compact_column.name: bindparam("ciphertext")})
+    else:
+        statement = (
+            statement
+            .where(legacy_column.is_not_distinct_from(bindparam("old_legacy", type_=Text)))
+            .values({compact_column.name: bindparam("ciphertext"), legacy_column.name: None})
+        )
+        # and rows holding no amount at all (NULL or the old "" default)
+        pending = or_(pending, and_(
+            compact_column.is_(None),
+            legacy_column.isnot(None),
+            legacy_column != "",
+        ))
+
+    last_key = checkpoint.get(table.name)
+    if last_key is not None:
+        # Dates are saved as ISO strings
+        last_key = [
+            date.fromisoformat(value) if column.type.python_type is date else value
+            for column, value in zip(key_columns, last_key)
+        ]
+    rotated = scanned = 0
+    started = time.perf_counter()
+    in_flight = deque()
+    exhausted = False
+
+    while in_flight or not exhausted:
+        while not exhausted and len(in_flight) < max_in_flight:
+            query = (
+                select(
+                    *key_columns,
+                    compact_column,
+                    null() if legacy_column is None else legacy_column,
+                )
+                .where(pending)
+                .order_by(*key_columns)
+                .limit(batch_size)
+            )
+            if last_key is not None:
+                query = query.where(key_tuple > tuple(last_key))
+
+            rows = db.session.execute(query).all()
+            db.session.rollback()  # don't hold a snapshot open between batches
+            if not rows:
+                exhausted = True
+                break
+
+            last_key = list(rows[-1][:len(key_columns)])
+            future = pool.submit(
+                reencrypt_amounts, [compact or legacy for *_, compact, legacy in rows]
+            )
+            in_flight.append((rows, future, last_key))
+
+        if not in_flight:
+            break
+
+        rows, future, batch_last_key = in_flight.popleft()
+        parameters = [
+            {
+                **{
+                    f"key_{column.name}": value
+                    for column, value in zip(key_columns, row[:len(key_columns)])
+                },
+                **({} if legacy_column is None else {"old_legacy": row[-1]}),
+                "old_compact": row[-2],
+                "ciphertext": ciphertext,
+            }
+            for row, ciphertext in zip(rows, future.result())
+            if ciphertext is not None
+        ]
+        if parameters:
+            db.session.execute(statement, parameters)
+        db.session.commit()
+
+        checkpoint[table.name] = batch_last_key
+        _save_checkpoint(checkpoint_path, checkpoint)
+
+        scanned += len(rows)
+        rotated += len(parameters)
+        elapsed = time.perf_counter() - started
+        print(
+            f"{table.name}: {rotated} rows re-encrypted, {scanned} scanned "
+            f"({scanned / elapsed:.0f} rows/s)"
+        )
+
+    return rotated
+
+
+@app.cli.command("rotate-keys")
+@click.option("--batch-size", default=2000, show_default=True)
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True)
+@click.option("--checkpoint", "checkpoint_path", default="rotate-keys.checkpoint.json",
+              show_default=True, help="Progress file used to resume an interrupted run")
+def rotate_keys(batch_size, workers, checkpoint_path):
+    """Re-encrypt every amount under the primary MONETARY_ENCRYPTION_KEYS key"""
+    portfolios = Portfolios.__table__
+    transactions = Transactions.__table__
+    snapshots = PortfolioSnapshots.__table__
+    reports = RebalanceReports.__table__
+    checkpoint = _load_checkpoint(checkpoint_path)
+    started = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rotated = _rotate_table(
+            pool,
+            transactions,
+            [transactions.c.id],
+            transactions.c.amount_encrypted,
+            transactions.c.amount_ciphertext,
+            batch_size, workers * 2, checkpoint, checkpoint_path,
+        )
+        rotated += _rotate_table(
+            pool,
+            portfolios,
+            [portfolios.c.user_id, portfolios.c.category_id],
+            portfolios.c.balance_encrypted,
+            portfolios.c.balance_ciphertext,
+            batch_size, workers * 2, checkpoint, checkpoint_path,
+        )
+        rotated += _rotate_table(
+            pool,
+            snapshots,
+            [snapshots.c.user_id, snapshots.c.category_id, snapshots.c.day],
+            None,
+            snapshots.c.balance_ciphertext,
+            batch_size, workers * 2, checkpoint, checkpoint_path,
+        )
+        rotated += _rotate_table(
+            pool,
+            reports,
+            [reports.c.user_id],
+            None,
+            reports.c.total_ciphertext,
+            batch_size, workers * 2, checkpoint, checkpoint_path,
+        )
+
+    elapsed = time.perf_counter() - started
+    print(f"Done: {rotated} rows re-encrypted in {elapsed:.1f}s")
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def _users_with_tails(after_user_id, limit):
+    """Next users, by id, having transactions above a checkpoint"""
+    return db.session.scalars(
+        select(Transactions.user_id)
+        .outerjoin(Portfolios, and_(
+            Portfolios.user_id == Transactions.user_id,
+            Portfolios.category_id == Transactions.category_id,
+        ))
+        .where(
+            Transactions.user_id > after_user_id,
+            Transactions.id > func.coalesce(Portfolios.checkpoint_transaction_id, 0),
+        )
+        .group_by(Transactions.user_id)
+        .order_by(Transactions.user_id)
+        .limit(limit)
+    ).all()
+
+
+@app.cli.command("compact-ledger")
+@click.option("--user-id", type=int, default=None, help="Only compact this user")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--every", type=float, default=None,
+              help="Keep running, compacting again every N seconds")
+def compact_ledger_command(user_id, batch_size, every):
+    """Fold appended transactions into the stored balances (ledger mode)"""
+    while True:
+        started = time.perf_counter()
+        folded = 0
+        users = 0
+
+        if user_id is not None:
+            user_ids = [user_id]
+        else:
+            user_ids = _users_with_tails(0, batch_size)
+
+        while user_ids:
+            for current_user_id in user_ids:
+                # One short transaction per user keeps row locks brief
+                folded += compact_ledger(current_user_id)
+                db.session.commit()
+                users += 1
+            if user_id is not None:
+                break
+            user_ids = _users_with_tails(user_ids[-1], batch_size)
+
+        elapsed = time.perf_counter() - started
+        print(f"Compacted {folded} balances of {users} users in {elapsed:.1f}s")
+
+        if every is None:
+            break
+        time.sleep(every)
+
+
+def _split_by_user(rows, parts):
+    """Split user-ordered rows into about `parts` chunks without splitting a user"""
+    target = max(1, len(rows) // parts + 1)
+    chunks = [[]]
+    for row in rows:
+        chunk = chunks[-1]
+        if len(chunk) >= target and chunk[-1][0] != row[0]:
+            chunk = []
+            chunks.append(chunk)
+        chunk.append(row)
+    return [chunk for chunk in chunks if chunk]
+
+
+@app.cli.command("rebuild-snapshots")
+@click.option("--batch-size", default=200, show_default=True, help="Users per batch")
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True)
+@click.option("--user-id", type=int, default=None, help="Only rebuild this user")
+def rebuild_snapshots(batch_size, workers, user_id):
+    """Recompute the daily balance snapshots from the transaction log"""
+    started = time.perf_counter()
+    users = written = 0
+    last_user_id = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            if user_id is not None:
+                user_ids = [user_id] if users == 0 else []
+            else:
+                user_ids = db.session.scalars(
+                    select(Users.id)
+                    .where(Users.id > last_user_id)
+                    .order_by(Users.id)
+                    .limit(batch_size)
+                ).all()
+            if not user_ids:
+                break
+
+            # The users' Portfolios rows stay locked until the commit below
+            rows = folded_transaction_rows(user_ids)
+            snapshot_rows = [
+                snapshot_row
+                for chunk in pool.map(closing_balance_rows, _split_by_user(rows, workers))
+                for snapshot_row in chunk
+            ]
+            replace_snapshots(user_ids, snapshot_rows)
+            db.session.commit()
+
+            last_user_id = user_ids[-1]
+            users += len(user_ids)
+            written += len(snapshot_rows)
+            elapsed = time.perf_counter() - started
+            print(f"{users} users, {written} snapshots ({users / elapsed:.0f} users/s)")
+
+    print(f"Done in {time.perf_counter() - started:.1f}s")
+
+
+@app.cli.command("rebalance-report")
+@click.option("--chunk-size", default=5000, show_default=True, help="Users per chunk")
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True)
+def rebalance_report(chunk_size, workers):
+    """Compute every user's allocation drift for /api/rebalance (nightly job)"""
+    started = time.perf_counter()
+    users = reports = 0
+    last_user_id = 0
+    in_flight = deque()
+    exhausted = False
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while in_flight or not exhausted:
+            # Read ahead while earlier chunks are decrypted in the workers
+            while not exhausted and len(in_flight) < workers * 2:
+                user_ids, risk_profiles, rows = read_chunk(last_user_id, chunk_size)
+                db.session.rollback()  # don't hold a snapshot open between chunks
+                if not user_ids:
+                    exhausted = True
+                    break
+                last_user_id = user_ids[-1]
+                future = pool.submit(decrypt_amounts, [row[2] for row in rows])
+                in_flight.append((user_ids, risk_profiles, rows, future))
+
+            if not in_flight:
+                break
+
+            user_ids, risk_profiles, rows, future = in_flight.popleft()
+            totals, weights, drift = allocation_drift(
+                user_ids, risk_profiles, rows, future.result()
+            )
+            reports += write_reports(user_ids, risk_profiles, totals, weights, drift)
+            db.session.commit()
+
+            users += len(user_ids)
+            elapsed = time.perf_counter() - started
+            print(f"{users} users, {reports} reports ({users / elapsed:.0f} users/s)")
+
+    print(f"Done in {time.perf_counter() - started:.1f}s")
@@ -23,6 +23,7 @@ CORS(app,
     origins=["http://localhost:5173", "http://127.0.0.1:5173"],
     supports_credentials=True,
     allow_headers=["Content-Type", "Authorization"],
+    expose_headers=["ETag", "X-Data-Version"],
     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
 
 # Initialize Firebase Admin SDK
@@ -46,6 +47,22 @@ if cred and not firebase_admin._apps:
     firebase_admin.initialize_app(cred)
     print("Firebase Admin SDK initialized successfully")
 
+# Optionally verify ID tokens locally against preloaded Google signing keys
+if os.environ.get('FIREBASE_TOKEN_VERIFICATION') == 'local':
+    firebase_project_id = os.environ.get('FIREBASE_PROJECT_ID') or (
+        cred.project_id if cred else None
+    )
+    if firebase_project_id:
+        from .token_verifier import configure_local_verifier
+        try:
+            configure_local_verifier(firebase_project_id)
+            print("Local Firebase token verification enabled")
+        except Exception as e:
+            print(f"Error preloading Firebase signing keys: {e}")
+            print("Falling back to Firebase Admin SDK token verification")
+    else:
+        print("Firebase project id not found - local token verification disabled")
+
 # Get the DATABASE_URL environment variable
 database_url = os.environ.get('DATABASE_URL')
 if database_url and database_url.startswith("postgres://"):
@@ -65,9 +82,33 @@ if not database_url:
 # Configure the SQLAlchemy database URI
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 
+# Connection pool of each worker process. Under gunicorn's gthread workers,
+# gunicorn.conf.py defaults it to one connection per thread
+if database_url and database_url.startswith("postgresql"):
+    engine_options = {
+        "pool_size": int(os.environ.get('DB_POOL_SIZE', 5)),
+        "max_overflow": int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        # Seconds to wait for a free connection before failing the request
+        "pool_timeout": int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        # Replace connections older than this many seconds (-1: never)
+        "pool_recycle": int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        # Check connections on checkout, dropping those closed by the server
+        "pool_pre_ping": os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+    # Milliseconds before PostgreSQL cancels a statement; 0 disables it
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+    if statement_timeout:
+        engine_options["connect_args"] = {
+            "options": f"-c statement_timeout={statement_timeout}"
+        }
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
 # Set-up secret key, necessary for session management (if needed for other purposes)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
 
+# Report per-request decrypt cost and cache counters in a Server-Timing header
+app.config["SERVER_TIMING"] = os.environ.get('SERVER_TIMING') == '1'
+
 # Only for development phase. Disable when deploying
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
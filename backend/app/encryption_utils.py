@@ -1,32 +1,181 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from contextvars import ContextVar
+from decimal import Decimal, ROUND_HALF_UP
 import os
+import time
 import base64
+import hashlib
+import struct
+from .cache_utils import BoundedTTLCache
+
+# Compact format: version byte | key id (4) | nonce (12) | AES-GCM(int64 cents) + tag
+COMPACT_V1 = b"\x01"
+_CENTS = struct.Struct(">q")
+_ONE = Decimal(1)
+
+# Decrypt counters for the current request, see start_decrypt_stats()
+decrypt_stats = ContextVar('decrypt_stats', default=None)
+
+
+def start_decrypt_stats():
+    """Start counting decrypt work for the current request/context"""
+    stats = {"calls": 0, "memo_hits": 0, "decrypted": 0, "seconds": 0.0}
+    decrypt_stats.set(stats)
+    return stats
+
+
+def _load_keys():
+    """Read the Fernet keys, primary first, from the environment"""
+    keys = os.environ.get('MONETARY_ENCRYPTION_KEYS') or os.environ.get(
+        'MONETARY_ENCRYPTION_KEY'
+    )
+    if keys:
+        return [key.strip().encode() for key in keys.split(',') if key.strip()]
+
+    # Amounts encrypted with a throwaway key are unreadable after a restart,
+    # so only allow one in development
+    if os.environ.get('FLASK_DEBUG') not in ('1', 'true', 'True'):
+        raise RuntimeError(
+            "MONETARY_ENCRYPTION_KEY is not set; refusing to encrypt amounts "
+            "with a throwaway key"
+        )
+    key = Fernet.generate_key()
+    print(f"Generated new development encryption key: {key.decode()}")
+    return [key]
+
+
+def _derive_aead_key(fernet_key):
+    """AEAD key for the compact format, derived from a Fernet key"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"helpinvest-monetary-amount-v1",
+    ).derive(base64.urlsafe_b64decode(fernet_key))
+
+
+def to_cents(amount) -> int:
+    """Whole cents of an amount, half up
+
+    Goes through the decimal form of the amount: float(amount) * 100 can
+    land just below a half cent (1.005 * 100 == 100.49999999999999).
+    """
+    return int((Decimal(str(float(amount))) * 100).quantize(_ONE, rounding=ROUND_HALF_UP))
+
 
 class MonetaryEncryption:
-    def __init__(self):
-        # Use environment variable or generate key (store securely!)
-        key = os.environ.get('MONETARY_ENCRYPTION_KEY')
-        if not key:
-            key = Fernet.generate_key()
-            print(f"Generated new encryption key: {key.decode()}")
-        else:
-            key = key.encode() if isinstance(key, str) else key
-        self.cipher = Fernet(key)
-    
-    def encrypt_amount(self, amount: float) -> str:
-        """Encrypt a monetary amount"""
-        amount_str = str(amount)
-        encrypted = self.cipher.encrypt(amount_str.encode())
-        return base64.b64encode(encrypted).decode()
-    
-    def decrypt_amount(self, encrypted_amount: str) -> float:
-        """Decrypt a monetary amount"""
+    def __init__(self, keys=None):
+        # Every configured key can decrypt; only the first one encrypts
+        keys = keys or _load_keys()
+        self.cipher = MultiFernet([Fernet(key) for key in keys])
+
+        self.aeads = {}
+        for key in keys:
+            aead_key = _derive_aead_key(key)
+            self.aeads[hashlib.sha256(aead_key).digest()[:4]] = AESGCM(aead_key)
+        self.key_id = hashlib.sha256(_derive_aead_key(keys[0])).digest()[:4]
+        self.aead = self.aeads[self.key_id]
+
+        # Ciphertext -> amount. Ciphertexts are never mutated in place, so a
+        # cached plaintext stays valid for as long as the ciphertext exists
+        self.memo = BoundedTTLCache(
+            maxsize=int(os.environ.get('DECRYPT_CACHE_SIZE', 65536))
+        )
+
+    def encrypt_many(self, amounts, memoize=True) -> list:
+        """Encrypt a batch of amounts"""
+        return [self.encrypt_amount(amount, memoize) for amount in amounts]
+
+    def encrypt_amount(self, amount: float, memoize=True) -> bytes:
+        """Encrypt a monetary amount in the compact binary format"""
+        cents = to_cents(amount)
+        header = COMPACT_V1 + self.key_id
+        nonce = os.urandom(12)
+        encrypted_amount = header + nonce + self.aead.encrypt(
+            nonce, _CENTS.pack(cents), header
+        )
+        if memoize:
+            self.memo.set(encrypted_amount, cents / 100)
+        return encrypted_amount
+
+    def decrypt_amount(self, encrypted_amount, memoize=True) -> float:
+        """Decrypt a monetary amount stored in the compact or legacy format"""
+        stats = decrypt_stats.get()
+        if stats is not None:
+            stats["calls"] += 1
+
+        amount = self.memo.get(encrypted_amount)
+        if amount is not None:
+            if stats is not None:
+                stats["memo_hits"] += 1
+            return amount
+
+        started = time.perf_counter()
+        amount = self._decrypt(encrypted_amount)
+        if memoize:
+            self.memo.set(encrypted_amount, amount)
+        if stats is not None:
+            stats["decrypted"] += 1
+            stats["seconds"] += time.perf_counter() - started
+        return amount
+
+    def decrypt_many(self, encrypted_amounts, memoize=True) -> list:
+        """Decrypt a batch of amounts; empty ciphertexts decrypt to 0.0
+
+        Pass memoize=False for one-off bulk reads (exports, analytics) so
+        they don't evict the hot portfolio balances from the memo.
+        """
+        return [
+            self.decrypt_amount(encrypted_amount, memoize) if encrypted_amount else 0.0
+            for encrypted_amount in encrypted_amounts
+        ]
+
+    def needs_rotation(self, encrypted_amount) -> bool:
+        """True unless the amount is compact and encrypted with the primary key"""
+        return not (
+            self.is_compact(encrypted_amount)
+            and encrypted_amount[1:5] == self.key_id
+        )
+
+    def is_compact(self, encrypted_amount) -> bool:
+        return isinstance(encrypted_amount, bytes) and (
+            encrypted_amount[:1] == COMPACT_V1
+        )
+
+    def _decrypt(self, encrypted_amount) -> float:
         try:
+            if self.is_compact(encrypted_amount):
+                return self._decrypt_compact(encrypted_amount)
+            # Legacy format: base64(Fernet token of str(amount)) in a Text column
             encrypted_bytes = base64.b64decode(encrypted_amount.encode())
             decrypted = self.cipher.decrypt(encrypted_bytes)
             return float(decrypted.decode())
         except Exception:
             raise ValueError("Invalid encrypted amount")
 
+    def _decrypt_compact(self, encrypted_amount: bytes) -> float:
+        header, nonce = encrypted_amount[:5], encrypted_amount[5:17]
+        aead = self.aeads.get(header[1:])
+        if aead is None:
+            raise ValueError("Unknown encryption key")
+        plaintext = aead.decrypt(nonce, encrypted_amount[17:], header)
+        return _CENTS.unpack(plaintext)[0] / 100
+
 # Singleton instance
-monetary_crypto = MonetaryEncryption()
\ No newline at end of file
+monetary_crypto = MonetaryEncryption()
+
+
+def reencrypt_amounts(encrypted_amounts):
+    """Re-encrypt a batch under the primary key, None where already current
+
+    Module-level so a process pool can run it; each worker uses its own
+    singleton built from the same environment.
+    """
+    return [
+        monetary_crypto.encrypt_amount(monetary_crypto._decrypt(encrypted_amount))
+        if monetary_crypto.needs_rotation(encrypted_amount) else None
+        for encrypted_amount in encrypted_amounts
+    ]
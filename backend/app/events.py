@@ -0,0 +1,316 @@
+import hashlib
+import json
+import os
+import queue
+import secrets
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import delete, event, text
+from .config import app, db
+from .models import StreamTickets
+from .encryption_utils import monetary_crypto
+from .categories import category_registry
+
+# "local": events reach the subscribers of the worker that committed.
+# "postgres": events go through LISTEN/NOTIFY and reach every worker.
+EVENTS_BROKER = os.environ.get('EVENTS_BROKER', 'local')
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+# Seconds between keep-alive comments on an idle stream
+EVENTS_KEEPALIVE = int(os.environ.get('EVENTS_KEEPALIVE', 15))
+# Open streams per process, 0 for no limit. Each stream holds a thread of a
+# gthread worker for as long as it is open (see gunicorn.conf.py).
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 0))
+EVENTS_CHANNEL = "helpinvest_events"
+# Seconds a ticket from POST /api/events/ticket can be redeemed
+STREAM_TICKET_TTL = int(os.environ.get('STREAM_TICKET_TTL', 30))
+
+
+class Subscription:
+    """Bounded queue of events for one /api/events connection
+
+    A subscriber that falls behind loses its backlog and receives a single
+    "resync" event telling it to refetch instead.
+    """
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Next event, or None if nothing arrived within timeout seconds"""
+        if self.overflowed:
+            self.overflowed = False
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            return {"type": "resync"}
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """In-process fan-out of events to the subscriptions of each user
+
+    Brokers are called twice per commit: stage() inside the transaction,
+    publish() once it has committed.
+    """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """New subscription, or None if EVENTS_MAX_STREAMS are already open"""
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            if self.is_full():
+                return None
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def is_full(self):
+        return 0 < EVENTS_MAX_STREAMS <= self._count
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions:
+                if subscription in subscriptions:
+                    subscriptions.discard(subscription)
+                    self._count -= 1
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscriptions
+
+    def deliver(self, user_id, event):
+        """Hand an event to this process's subscriptions of the user"""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def deliver_all(self, event):
+        with self._lock:
+            subscriptions = [
+                subscription
+                for user_subscriptions in self._subscriptions.values()
+                for subscription in user_subscriptions
+            ]
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def reset(self):
+        """Forget state inherited from a parent process (after a fork)"""
+        self._subscriptions = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def stage(self, session, user_id, event):
+        """Called inside the committing transaction"""
+
+    def publish(self, user_id, event):
+        """Called once the transaction has committed"""
+        self.deliver(user_id, event)
+
+
+class PostgresBroker(LocalBroker):
+    """Shares events between workers through PostgreSQL LISTEN/NOTIFY
+
+    NOTIFY is issued inside the committing transaction, so PostgreSQL only
+    delivers it if the commit succeeds. Payloads carry the user id in clear
+    (to skip users without local subscribers) and the event encrypted with
+    the primary amount key. Each process listens on its own connection,
+    opened by a thread started on the first subscription.
+    """
+
+    def __init__(self, channel=EVENTS_CHANNEL):
+        super().__init__()
+        self.channel = channel
+        self._listener = None
+
+    def stage(self, session, user_id, event):
+        token = monetary_crypto.cipher.encrypt(json.dumps(event).encode()).decode()
+        session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": self.channel, "payload": f"{user_id}:{token}"}
+        )
+
+    def publish(self, user_id, event):
+        # Delivered by the listener, in this process as in the others
+        pass
+
+    def reset(self):
+        # The listener thread and its connection belong to the parent
+        super().reset()
+        self._listener = None
+
+    def subscribe(self, user_id):
+        self.start_listener()
+        return super().subscribe(user_id)
+
+    def start_listener(self):
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(
+                target=self._listen, name="events-listener", daemon=True
+            )
+            self._listener.start()
+
+    def _dispatch(self, payload):
+        user_id, _, token = payload.partition(":")
+        user_id = int(user_id)
+        if self.has_subscribers(user_id):
+            self.deliver(user_id, json.loads(monetary_crypto.cipher.decrypt(token.encode())))
+
+    def _listen(self):
+        while True:
+            connection = None
+            try:
+                with app.app_context():
+                    # Detached: the connection stays out of the pool for good
+                    connection = db.engine.raw_connection()
+                    connection.detach()
+                driver_connection = connection.driver_connection
+                driver_connection.autocommit = True
+                with driver_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel}")
+                # Events may have been missed while (re)connecting
+                self.deliver_all({"type": "resync"})
+
+                while True:
+                    if select.select([driver_connection], [], [], 30) == ([], [], []):
+                        continue
+                    driver_connection.poll()
+                    while driver_connection.notifies:
+                        notify = driver_connection.notifies.pop(0)
+                        try:
+                            self._dispatch(notify.payload)
+                        except Exception as e:
+                            print(f"Invalid event payload: {str(e)}")
+
+            except Exception as e:
+                print(f"Events listener error: {str(e)}")
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                time.sleep(1)
+
+
+event_broker = PostgresBroker() if EVENTS_BROKER == "postgres" else LocalBroker()
+
+
+def _ticket_id(ticket):
+    return hashlib.sha256(ticket.encode()).hexdigest()
+
+
+def issue_stream_ticket(user_id, token_expires_at):
+    """New single-use ticket opening an /api/events stream; the caller commits
+
+    EventSource cannot send the Authorization header, so streams are opened
+    with ?ticket= instead of the ID token: the URL, which ends up in access
+    logs, only carries a secret that is short-lived and already redeemed.
+    Only its hash is stored. The stream ends when the ID token expires.
+    """
+    now = datetime.utcnow()
+    db.session.execute(
+        delete(StreamTickets)
+        .where(StreamTickets.user_id == user_id, StreamTickets.expires_at <= now)
+    )
+    ticket = secrets.token_urlsafe(32)
+    db.session.add(StreamTickets(
+        id=_ticket_id(ticket),
+        user_id=user_id,
+        expires_at=now + timedelta(seconds=STREAM_TICKET_TTL),
+        stream_expires_at=datetime.utcfromtimestamp(token_expires_at),
+    ))
+    return ticket
+
+
+def redeem_stream_ticket(ticket):
+    """Consume a ticket: (user_id, stream_expires_at), or None if it is
+    unknown, expired or already used. The caller commits."""
+    return db.session.execute(
+        delete(StreamTickets)
+        .where(
+            StreamTickets.id == _ticket_id(ticket),
+            StreamTickets.expires_at > datetime.utcnow(),
+        )
+        .returning(StreamTickets.user_id, StreamTickets.stream_expires_at)
+    ).first()
+
+
+def queue_event(user_id, event):
+    """Send an event to the user's /api/events streams once the session commits"""
+    db.session.info.setdefault("events", []).append((user_id, event))
+
+
+def queue_balance_delta(user_id, category_id, amount):
+    """Announce a balance change to /api/events once the session commits"""
+    deltas = db.session.info.setdefault("balance_deltas", {}).setdefault(user_id, {})
+    deltas[category_id] = deltas.get(category_id, 0.0) + amount
+
+
+def _balance_events(deltas_by_user):
+    for user_id, deltas in deltas_by_user.items():
+        changes = []
+        for category_id, delta in sorted(deltas.items()):
+            delta = round(delta, 2)
+            if not delta:
+                continue
+            category_name, sub_category = category_registry.get_names(category_id)
+            changes.append({
+                "category_name": category_name,
+                "sub_category": sub_category,
+                "delta": delta,
+            })
+        if changes:
+            yield user_id, {
+                "type": "balances",
+                "deltas": changes,
+                "total_delta": round(sum(change["delta"] for change in changes), 2),
+            }
+
+
+@event.listens_for(db.session, "before_commit")
+def _stage_events(session):
+    staged = list(_balance_events(session.info.pop("balance_deltas", {})))
+    staged.extend(session.info.pop("events", ()))
+    if not staged:
+        return
+    session.info["staged_events"] = staged
+    for user_id, user_event in staged:
+        event_broker.stage(session, user_id, user_event)
+
+
+@event.listens_for(db.session, "after_commit")
+def _publish_events(session):
+    for user_id, user_event in session.info.pop("staged_events", ()):
+        event_broker.publish(user_id, user_event)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _drop_events(session):
+    session.info.pop("balance_deltas", None)
+    session.info.pop("events", None)
+    session.info.pop("staged_events", None)
@@ -1,7 +1,54 @@
+import os
 import re
-from flask import request, jsonify
+import hashlib
+import time
+from flask import request, jsonify, make_response, g
 from functools import wraps
 from firebase_admin import auth
+from .cache_utils import BoundedTTLCache
+from .token_verifier import get_local_verifier
+
+
+# Verified Firebase ID tokens, keyed by a SHA-256 of the raw token
+token_cache = BoundedTTLCache(
+    maxsize=int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+)
+
+
+def _token_cache_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def verify_firebase_token(token):
+    """Verify a Firebase ID token, reusing the result until the token expires"""
+    key = _token_cache_key(token)
+    decoded_token = token_cache.get(key)
+    if decoded_token is not None:
+        return decoded_token
+
+    # Verify against the preloaded signing keys when local mode is enabled
+    verifier = get_local_verifier()
+    if verifier is not None:
+        decoded_token = verifier.verify(token)
+    else:
+        decoded_token = auth.verify_id_token(token)
+
+    expires_at = decoded_token.get('exp')
+    if expires_at and expires_at > time.time():
+        token_cache.set(key, decoded_token, expires_at=expires_at)
+    return decoded_token
+
+
+def invalidate_token_cache(token=None, firebase_uid=None):
+    """Drop cached verifications for a token, for a user, or all of them"""
+    if token is not None:
+        if token.startswith('Bearer '):
+            token = token[7:]
+        token_cache.discard(_token_cache_key(token))
+    elif firebase_uid is not None:
+        token_cache.discard_where(lambda decoded: decoded.get('uid') == firebase_uid)
+    else:
+        token_cache.clear()
 
 
 def firebase_token_required(f):
@@ -21,10 +68,12 @@ def firebase_token_required(f):
             if token.startswith('Bearer '):
                 token = token[7:]
             
-            # Verify the Firebase ID token
-            decoded_token = auth.verify_id_token(token)
+            # Verify the Firebase ID token (cached until it expires)
+            decoded_token = verify_firebase_token(token)
             user_id = decoded_token['uid']
             user_email = decoded_token.get('email')
+            # Lets handlers bound what they grant to the token's lifetime
+            g.token_expires_at = decoded_token.get('exp')
             
             # Pass user info to the function
             return f(user_id, user_email, *args, **kwargs)
@@ -49,13 +98,171 @@ def firebase_token_required(f):
     return decorated_function
 
 
+class UserRecord:
+    """Detached, read-only copy of the Users columns handlers need"""
+    __slots__ = ('id', 'firebase_uid', 'email', 'username', 'risk_profile', 'data_version')
+
+    def __init__(self, id, firebase_uid, email, username, risk_profile, data_version):
+        self.id = id
+        self.firebase_uid = firebase_uid
+        self.email = email
+        self.username = username
+        self.risk_profile = risk_profile
+        # Version of the row this copy was read at
+        self.data_version = data_version
+
+    @classmethod
+    def from_model(cls, user):
+        return cls(
+            user.id, user.firebase_uid, user.email, user.username, user.risk_profile,
+            user.data_version
+        )
+
+    def replace(self, **changes):
+        """Return a copy with some fields changed"""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return UserRecord(**fields)
+
+
+# firebase_uid -> UserRecord, refreshed after USER_CACHE_TTL seconds so that
+# changes made by other workers are eventually picked up
+user_cache = BoundedTTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 4096)),
+    ttl=int(os.environ.get('USER_CACHE_TTL', 300))
+)
+
+
+def resolve_user(firebase_uid):
+    """Return the UserRecord for a Firebase uid, or None if it does not exist"""
+    user = user_cache.get(firebase_uid)
+    if user is not None:
+        return user
+
+    from .models import Users
+
+    row = Users.query.filter_by(firebase_uid=firebase_uid).first()
+    if not row:
+        return None
+
+    user = UserRecord.from_model(row)
+    user_cache.set(firebase_uid, user)
+    return user
+
+
+def resolve_current_user(user, data_version):
+    """The user's record, reloaded if the cached copy predates data_version
+
+    Writes to the Users row (e.g. the risk profile) bump the data version,
+    so a copy cached by this worker before a write made by another one is
+    detected here. Returns None if the user no longer exists.
+    """
+    if user.data_version == data_version:
+        return user
+    invalidate_user_cache(user.firebase_uid)
+    return resolve_user(user.firebase_uid)
+
+
+def invalidate_user_cache(firebase_uid=None):
+    """Drop the cached user record for a uid, or every record"""
+    if firebase_uid is not None:
+        user_cache.discard(firebase_uid)
+    else:
+        user_cache.clear()
+
+
+def firebase_user_required(f):
+    """Decorator to require a Firebase ID token and pass the resolved user"""
+    @wraps(f)
+    @firebase_token_required
+    def decorated_function(firebase_uid, user_email, *args, **kwargs):
+        user = resolve_user(firebase_uid)
+        if not user:
+            return jsonify({
+                "success": False,
+                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
+            }), 404
+
+        return f(user, *args, **kwargs)
+
+    return decorated_function
+
+
+def bump_data_version(user_id):
+    """Increment the user's data version in the current transaction"""
+    from sqlalchemy import update
+    from .config import db
+    from .models import Users
+
+    return db.session.execute(
+        update(Users)
+        .where(Users.id == user_id)
+        .values(data_version=Users.data_version + 1)
+        .returning(Users.data_version)
+    ).scalar_one()
+
+
+def current_data_version(user_id):
+    """Read the user's data version straight from the database"""
+    from sqlalchemy import select
+    from .config import db
+    from .models import Users
+
+    return db.session.execute(
+        select(Users.data_version).where(Users.id == user_id)
+    ).scalar()
+
+
+def conditional_on_data_version(f):
+    """Decorator answering GETs with 304 while the user's data is unchanged
+
+    The ETag is derived from the user's data version and the full request
+    path, and is checked before the handler runs any portfolio query. The
+    version is read from the database on every request so that writes made
+    by other workers are seen; it is exposed to the handler as g.data_version.
+    """
+    @wraps(f)
+    def decorated_function(user, *args, **kwargs):
+        if request.method != "GET":
+            return f(user, *args, **kwargs)
+
+        # The ETag covers the user fields too: never serve a stale cached copy
+        user = resolve_current_user(user, current_data_version(user.id))
+        if user is None:
+            return jsonify({
+                "success": False,
+                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
+            }), 404
+        version = user.data_version
+        etag = hashlib.sha256(
+            f"{user.id}:{version}:{request.full_path}".encode()
+        ).hexdigest()[:32]
+
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+        else:
+            g.data_version = version
+            response = make_response(f(user, *args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        # Lets a client that loaded full state continue with /api/changes
+        response.headers["X-Data-Version"] = str(version)
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Authorization")
+        return response
+
+    return decorated_function
+
+
 def get_user_from_token(token):
     """Helper function to get user info from Firebase token"""
     try:
         if token.startswith('Bearer '):
             token = token[7:]
         
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = verify_firebase_token(token)
         return {
             'uid': decoded_token['uid'],
             'email': decoded_token.get('email'),
@@ -76,6 +283,16 @@ def serialize_category(category):
     }
 
 
+def serialize_user(user):
+    """Helper to serialize user objects for API responses"""
+    return {
+        "id": user.id,
+        "email": user.email,
+        "username": user.username,
+        "risk_profile": user.risk_profile
+    }
+
+
 def eur(value):
     """Format value as EUR"""
     return f"{value:,.0f} €".replace(",", " ").replace(".", ",")
@@ -85,37 +302,13 @@ def percentage(value):
     """Format value as percentage"""
     return f"{value * 100:,.0f}%"
 
-def get_category_data(user_id, category_name):
+def get_category_data(user_id, category_name, data_version=None):
     """Helper function to get portfolio data for a specific category"""
-    from .config import db
-    from .models import Categories, Portfolios
-    
-    # Use ORM objects to properly decrypt balances
-    category_data = (
-        db.session.query(Portfolios, Categories)
-        .join(Categories, Portfolios.category_id == Categories.id)
-        .filter(
-            Portfolios.user_id == user_id,
-            Categories.category_name == category_name
-        )
-        .all()
-    )
-
-    total_amount = 0
-    category_summary = {}
+    from .portfolio import get_portfolio_snapshot, category_view
 
-    for portfolio, category in category_data:
-        balance = portfolio.balance  # This will decrypt automatically
-        sub_category_name = category.sub_category
-        
-        if balance > 0:  # Only include non-zero balances
-            total_amount += balance
-
-            if sub_category_name not in category_summary:
-                category_summary[sub_category_name] = 0
-            category_summary[sub_category_name] += balance
-
-    return category_summary, total_amount
+    return category_view(
+        get_portfolio_snapshot(user_id, data_version=data_version), category_name
+    )
 
     
 # Legacy functions - kept for backward compatibility but no longer used
@@ -0,0 +1,232 @@
+import base64
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import func, select, tuple_
+from .config import db
+from .models import DeletedTransactions, Transactions
+from .encryption_utils import monetary_crypto
+from .categories import category_registry
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Above this many changed rows, /api/changes asks for a full reload instead
+CHANGES_MAX_ROWS = int(os.environ.get('CHANGES_MAX_ROWS', 5000))
+
+
+def encode_cursor(timestamp, transaction_id):
+    """Opaque cursor pointing just after a (timestamp, id) position
+
+    timestamp is None past the dated transactions, among the undated ones.
+    """
+    raw = json.dumps([
+        timestamp.isoformat() if timestamp is not None else None, transaction_id
+    ]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); raises ValueError on a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, transaction_id = json.loads(raw)
+        if timestamp is not None:
+            timestamp = datetime.fromisoformat(timestamp)
+        return timestamp, int(transaction_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def serialize_transactions(rows, memoize=True):
+    """Turn (id, category_id, timestamp, compact, legacy) rows into API dicts"""
+    amounts = monetary_crypto.decrypt_many(
+        (compact or legacy for _, _, _, compact, legacy in rows), memoize
+    )
+    history = []
+    for (transaction_id, category_id, timestamp, _, _), amount in zip(rows, amounts):
+        category_name, sub_category_name = category_registry.get_names(category_id)
+        history.append({
+            "id": transaction_id,
+            "category_name": category_name,
+            "sub_category_name": sub_category_name,
+            "amount": amount,
+            "timestamp": timestamp.strftime(TIMESTAMP_FORMAT) if timestamp else None,
+        })
+    return history
+
+
+def _history_columns():
+    return select(
+        Transactions.id,
+        Transactions.category_id,
+        Transactions.timestamp,
+        Transactions.amount_ciphertext,
+        Transactions.amount_encrypted,
+    )
+
+
+def fetch_history_page(user_id, cursor=None, per_page=10, include_total=False):
+    """One page of the user's history, newest first, using keyset pagination
+
+    The (timestamp, id) cursor lets the (user_id, timestamp DESC, id DESC)
+    index seek straight to the page, so deep pages cost the same as the
+    first one. Transactions without a timestamp come last, newest id first.
+    The total is only counted when asked for.
+    """
+    timestamp, transaction_id = decode_cursor(cursor) if cursor else (None, None)
+    rows = []
+
+    # Dated transactions, unless the cursor is already past them
+    if not cursor or timestamp is not None:
+        query = (
+            _history_columns()
+            .where(Transactions.user_id == user_id, Transactions.timestamp.isnot(None))
+            .order_by(Transactions.timestamp.desc(), Transactions.id.desc())
+            .limit(per_page + 1)
+        )
+        if cursor:
+            query = query.where(
+                tuple_(Transactions.timestamp, Transactions.id) < (timestamp, transaction_id)
+            )
+        rows = db.session.execute(query).all()
+
+    # Then the undated ones
+    if len(rows) <= per_page:
+        query = (
+            _history_columns()
+            .where(Transactions.user_id == user_id, Transactions.timestamp.is_(None))
+            .order_by(Transactions.id.desc())
+            .limit(per_page + 1 - len(rows))
+        )
+        if cursor and timestamp is None:
+            query = query.where(Transactions.id < transaction_id)
+        rows += db.session.execute(query).all()
+
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    pagination = {
+        "per_page": per_page,
+        "has_next": has_next,
+        "next_cursor": encode_cursor(rows[-1][2], rows[-1][0]) if has_next else None,
+    }
+    if include_total:
+        pagination["total"] = db.session.execute(
+            select(func.count())
+            .select_from(Transactions)
+            .where(Transactions.user_id == user_id)
+        ).scalar()
+
+    return serialize_transactions(rows), pagination
+
+
+def fetch_changes(user_id, since, until):
+    """Transactions inserted and deleted with since < version <= until
+
+    Returns (transactions, deleted_ids, category_ids) where category_ids
+    are the categories whose balance changed, or None when more than
+    CHANGES_MAX_ROWS rows changed and a full reload is cheaper.
+    """
+    rows = db.session.execute(
+        select(
+            Transactions.id,
+            Transactions.category_id,
+            Transactions.timestamp,
+            Transactions.amount_ciphertext,
+            Transactions.amount_encrypted,
+        )
+        .where(
+            Transactions.user_id == user_id,
+            Transactions.version > since,
+            Transactions.version <= until,
+        )
+        .order_by(Transactions.id)
+        .limit(CHANGES_MAX_ROWS + 1)
+    ).all()
+    deleted = db.session.execute(
+        select(DeletedTransactions.id, DeletedTransactions.category_id)
+        .where(
+            DeletedTransactions.user_id == user_id,
+            DeletedTransactions.version > since,
+            DeletedTransactions.version <= until,
+        )
+        .order_by(DeletedTransactions.id)
+        .limit(CHANGES_MAX_ROWS + 1)
+    ).all()
+    if len(rows) + len(deleted) > CHANGES_MAX_ROWS:
+        return None
+
+    transactions = serialize_transactions(rows)
+    category_ids = {row[1] for row in rows} | {row[1] for row in deleted}
+    return transactions, [row[0] for row in deleted], category_ids
+
+
+def iter_transaction_batches(user_id, start=None, end=None, category_names=None,
+                             batch_size=1000):
+    """Yield the user's transactions, oldest first, in serialized batches
+
+    Rows come from a server-side cursor (yield_per) and are decrypted one
+    batch at a time, so memory stays flat whatever the history size.
+    start and end are dates; end is inclusive. Transactions without a
+    timestamp come last, unless a date range is given.
+    """
+    dated = (
+        _history_columns()
+        .where(Transactions.user_id == user_id, Transactions.timestamp.isnot(None))
+        .order_by(Transactions.timestamp, Transactions.id)
+    )
+    if start:
+        dated = dated.where(Transactions.timestamp >= start)
+    if end:
+        dated = dated.where(Transactions.timestamp < end + timedelta(days=1))
+    queries = [dated]
+    if not start and not end:
+        queries.append(
+            _history_columns()
+            .where(Transactions.user_id == user_id, Transactions.timestamp.is_(None))
+            .order_by(Transactions.id)
+        )
+
+    for query in queries:
+        if category_names:
+            query = query.where(
+                Transactions.category_id.in_(category_registry.get_ids(category_names))
+            )
+        query = query.execution_options(yield_per=batch_size)
+        for rows in db.session.execute(query).partitions():
+            yield serialize_transactions(rows, memoize=False)
+
+
+EXPORT_FIELDS = ["id", "timestamp", "category_name", "sub_category_name", "amount"]
+
+
+def export_csv(batches):
+    """Stream batches as CSV text, one chunk per batch"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_ndjson(batches):
+    """Stream batches as newline-delimited JSON"""
+    for batch in batches:
+        yield "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch)
+
+
+def gzip_stream(chunks):
+    """Compress a stream of text chunks into a single gzip member"""
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,130 @@
+import csv
+import io
+import math
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from sqlalchemy import insert
+from .config import db
+from .models import Transactions
+from .encryption_utils import monetary_crypto
+from .categories import category_registry
+from .history import TIMESTAMP_FORMAT
+from .portfolio import mark_portfolio_changed
+from .ledger import check_balance_deltas, write_balances
+from .events import queue_balance_delta
+
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', 50000))
+
+
+def parse_import_rows(request):
+    """Read import rows from a JSON array, a CSV body or a CSV file upload
+
+    CSV files use the export column names (category_name, sub_category_name,
+    amount, timestamp); JSON rows may also use categoryName/subCategory.
+    """
+    if request.is_json:
+        data = request.get_json()
+        rows = data.get("transactions") if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            raise ValueError("Une liste de transactions est attendue")
+        return rows
+
+    if "file" in request.files:
+        text = request.files["file"].read().decode("utf-8-sig")
+    elif request.mimetype == "text/csv":
+        text = request.get_data(as_text=True)
+    else:
+        raise ValueError("Format d'import non pris en charge (JSON ou CSV)")
+
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def _parse_timestamp(value):
+    if not value:
+        return datetime.utcnow()
+    try:
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
+    except ValueError:
+        timestamp = datetime.fromisoformat(value)
+    # Stored timestamps are naive UTC: convert ISO 8601 offsets to it
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def validate_import_rows(rows):
+    """Validate every row up front
+
+    Returns (entries, errors): entries are (category_id, amount, timestamp)
+    tuples; errors are {"row": index, "message": ...} dicts. Positive
+    amounts are investments, negative amounts withdrawals.
+    """
+    entries = []
+    errors = []
+
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append({"row": index, "message": "Ligne invalide"})
+            continue
+
+        category_name = row.get("categoryName") or row.get("category_name")
+        sub_category = row.get("subCategory") or row.get("sub_category_name")
+        category_id = category_registry.get_id(category_name, sub_category)
+        if category_id is None:
+            errors.append({
+                "row": index,
+                "message": "Cette combinaison de catégorie et de sous-catégorie n'existe pas"
+            })
+            continue
+
+        try:
+            amount = round(float(row.get("amount")), 2)
+        except (ValueError, TypeError):
+            errors.append({"row": index, "message": "Montant invalide"})
+            continue
+        if not math.isfinite(amount) or amount == 0:
+            errors.append({"row": index, "message": "Le montant doit être différent de zéro"})
+            continue
+
+        try:
+            timestamp = _parse_timestamp(row.get("timestamp"))
+        except (ValueError, TypeError):
+            errors.append({"row": index, "message": "Date invalide"})
+            continue
+
+        entries.append((category_id, amount, timestamp))
+
+    return entries, errors
+
+
+def import_transactions(user_id, entries):
+    """Insert validated entries and update each touched balance once
+
+    Balances are locked and checked against the net delta per category
+    first, then amounts are encrypted in one batch and inserted with a
+    single executemany. Runs in the caller's transaction; raises
+    InsufficientBalanceError if a category would end up negative.
+    """
+    deltas = defaultdict(float)
+    for category_id, amount, _ in entries:
+        deltas[category_id] += amount
+    portfolios, balances = check_balance_deltas(user_id, deltas)
+
+    ciphertexts = monetary_crypto.encrypt_many(
+        (amount for _, amount, _ in entries), memoize=False
+    )
+    db.session.execute(insert(Transactions), [
+        {
+            "user_id": user_id,
+            "category_id": category_id,
+            "amount_ciphertext": ciphertext,
+            "timestamp": timestamp,
+        }
+        for (category_id, _, timestamp), ciphertext in zip(entries, ciphertexts)
+    ])
+
+    write_balances(user_id, portfolios, balances)
+    for category_id, delta in deltas.items():
+        queue_balance_delta(user_id, category_id, delta)
+    mark_portfolio_changed(user_id)
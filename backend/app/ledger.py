@@ -0,0 +1,257 @@
+from datetime import datetime
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from .config import db
+from .models import DeletedTransactions, Portfolios, Transactions
+from .portfolio import WRITE_MODE, mark_portfolio_changed, tail_amounts
+from .snapshots import apply_snapshot_flows, folded_flows
+from .events import queue_balance_delta
+
+# A balance is always the stored balance plus the amounts of the user's
+# transactions in that category with an id above checkpoint_transaction_id.
+#
+# Lock order: Portfolios rows (by category_id), then the Users row through
+# mark_portfolio_changed(). Call mark_portfolio_changed() last, or let
+# commit_write() do it.
+
+# Tries at bumping the data version once an append is committed
+BUMP_ATTEMPTS = 3
+
+
+class InsufficientBalanceError(ValueError):
+    """A write would leave a sub-category balance below zero"""
+
+    def __init__(self, category_id, balance):
+        super().__init__(f"Insufficient balance for category {category_id}")
+        self.category_id = category_id
+        self.balance = balance
+
+
+def _ensure_rows(user_id, category_ids):
+    """Create missing Portfolios rows so they can be locked"""
+    rows = [
+        {"user_id": user_id, "category_id": category_id, "checkpoint_transaction_id": 0}
+        for category_id in sorted(category_ids)
+    ]
+    if not rows:
+        return
+
+    if db.session.get_bind().dialect.name == "postgresql":
+        db.session.execute(pg_insert(Portfolios).values(rows).on_conflict_do_nothing())
+        return
+
+    existing = set(db.session.scalars(
+        select(Portfolios.category_id).where(
+            Portfolios.user_id == user_id,
+            Portfolios.category_id.in_(sorted(category_ids))
+        )
+    ))
+    missing = [row for row in rows if row["category_id"] not in existing]
+    if missing:
+        db.session.execute(insert(Portfolios), missing)
+
+
+def lock_portfolios(user_id, category_ids, shared=False):
+    """Lock the user's rows for these categories, creating missing ones
+
+    FOR UPDATE by default; shared=True takes FOR SHARE, which lets appends
+    run side by side while keeping compaction out. Rows are locked in
+    category_id order so concurrent writers cannot deadlock. Returns
+    {category_id: Portfolios}.
+    """
+    _ensure_rows(user_id, category_ids)
+    portfolios = (
+        Portfolios.query
+        .filter(
+            Portfolios.user_id == user_id,
+            Portfolios.category_id.in_(sorted(category_ids))
+        )
+        .order_by(Portfolios.category_id)
+        .with_for_update(read=shared)
+        .populate_existing()
+        .all()
+    )
+    return {portfolio.category_id: portfolio for portfolio in portfolios}
+
+
+def locked_balances(user_id, category_ids):
+    """Lock rows FOR UPDATE and return (portfolios, current balances)
+
+    Holding FOR UPDATE waits out in-flight appends, so the balances include
+    every committed transaction. Call before adding new transactions to the
+    session.
+    """
+    portfolios = lock_portfolios(user_id, category_ids)
+    tails = tail_amounts(user_id, portfolios.keys())
+    balances = {
+        category_id: round(portfolio.balance + tails.get(category_id, 0.0), 2)
+        for category_id, portfolio in portfolios.items()
+    }
+    return portfolios, balances
+
+
+def write_balances(user_id, portfolios, balances, deleted=()):
+    """Store balances ({category_id: balance}) on rows from locked_balances()
+
+    Pending inserts and deletes are flushed first and the checkpoint moves
+    to the last transaction of each category, so the stored balance
+    accounts for all of them. Each row is re-encrypted once, and the daily
+    snapshots receive the newly folded transactions. deleted lists the
+    transactions removed in this write; each leaves a tombstone.
+    """
+    previous = {
+        category_id: portfolios[category_id].checkpoint_transaction_id or 0
+        for category_id in balances
+    }
+    folded_deletes = [
+        transaction for transaction in deleted
+        if transaction.id <= previous.get(transaction.category_id, 0)
+    ]
+    db.session.add_all(
+        DeletedTransactions(
+            id=transaction.id,
+            user_id=user_id,
+            category_id=transaction.category_id,
+        )
+        for transaction in deleted
+    )
+
+    db.session.flush()
+    checkpoints = dict(db.session.execute(
+        select(Transactions.category_id, func.max(Transactions.id))
+        .where(
+            Transactions.user_id == user_id,
+            Transactions.category_id.in_(sorted(balances))
+        )
+        .group_by(Transactions.category_id)
+    ).all())
+
+    ranges = {}
+    for category_id in sorted(balances):
+        portfolio = portfolios[category_id]
+        portfolio.balance = balances[category_id]
+        portfolio.checkpoint_transaction_id = max(
+            previous[category_id], checkpoints.get(category_id) or 0
+        )
+        ranges[category_id] = (previous[category_id], portfolio.checkpoint_transaction_id)
+
+    apply_snapshot_flows(user_id, folded_flows(user_id, ranges, folded_deletes))
+
+
+def check_balance_deltas(user_id, deltas):
+    """Lock the touched rows and compute the balances after net deltas
+
+    Raises InsufficientBalanceError if a balance would end up negative.
+    Returns (portfolios, new_balances); pass them to write_balances() once
+    the matching transactions are in the session.
+    """
+    portfolios, balances = locked_balances(user_id, deltas.keys())
+
+    for category_id in sorted(deltas):
+        # Amounts are stored in cents
+        balance = round(balances[category_id] + deltas[category_id], 2)
+        if balance < 0:
+            raise InsufficientBalanceError(category_id, balance)
+        balances[category_id] = balance
+
+    return portfolios, balances
+
+
+def record_transaction(user_id, category_id, amount, strict=False):
+    """Add an investment (amount > 0) or a withdrawal (amount < 0)
+
+    In ledger mode an investment only takes a shared lock and appends its
+    row. Withdrawals, and every write in balance mode (or with strict=True),
+    lock the row, check the balance and fold it. Returns the new
+    transaction; the caller commits.
+    """
+    transaction = Transactions(
+        user_id=user_id,
+        category_id=category_id,
+        amount=amount,
+        timestamp=datetime.utcnow(),
+    )
+
+    if WRITE_MODE == "ledger" and amount > 0 and not strict:
+        lock_portfolios(user_id, [category_id], shared=True)
+        db.session.add(transaction)
+        db.session.info["ledger_append"] = True
+    else:
+        portfolios, balances = check_balance_deltas(user_id, {category_id: amount})
+        db.session.add(transaction)
+        write_balances(user_id, portfolios, balances)
+
+    queue_balance_delta(user_id, category_id, amount)
+    return transaction
+
+
+def commit_write(user_id):
+    """Commit a write and bump the user's data version
+
+    An append is committed on its own first, holding nothing but its FOR
+    SHARE lock, so appends of one user don't wait for each other; the data
+    version is then bumped and the new rows stamped in a short second
+    transaction. Other writes are committed with the bump.
+
+    Returns (version, exclusive). exclusive is False when the version may
+    also cover appends committed concurrently, so a snapshot derived from
+    the previous version can't be trusted. The bump is retried, as the
+    append can't be undone; version is None if it still failed: ETags then
+    match the previous data until the next write of the user (or
+    compact-ledger) stamps its row.
+    """
+    if not db.session.info.pop("ledger_append", False):
+        version = mark_portfolio_changed(user_id)
+        db.session.commit()
+        return version, True
+
+    db.session.commit()
+    for _ in range(BUMP_ATTEMPTS):
+        try:
+            version = mark_portfolio_changed(user_id)
+            db.session.commit()
+            return version, False
+        except Exception as e:
+            db.session.rollback()
+            print(f"Exception occurred: {str(e)}")
+    return None, False
+
+
+def remove_transaction(user_id, transaction):
+    """Delete a transaction and take its amount out of the balance"""
+    category_id = transaction.category_id
+    portfolios, balances = locked_balances(user_id, [category_id])
+    balances[category_id] = round(balances[category_id] - transaction.amount, 2)
+    db.session.delete(transaction)
+    write_balances(user_id, portfolios, balances, deleted=[transaction])
+    queue_balance_delta(user_id, category_id, -transaction.amount)
+
+
+def compact_ledger(user_id):
+    """Fold the appended transactions of a user into the stored balances
+
+    Balances do not change, so the data version and caches stay valid,
+    unless some appends were committed without their version stamp (see
+    commit_write()): those are stamped now. Returns the number of
+    categories folded; the caller commits.
+    """
+    category_ids = list(tail_amounts(user_id))
+    if not category_ids:
+        return 0
+
+    portfolios, balances = locked_balances(user_id, category_ids)
+    write_balances(user_id, portfolios, balances)
+
+    unstamped = db.session.scalar(
+        select(Transactions.id)
+        .where(Transactions.user_id == user_id, Transactions.version.is_(None))
+        .limit(1)
+    )
+    if unstamped is not None:
+        mark_portfolio_changed(user_id)
+    return len(category_ids)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_ledger_append(session):
+    session.info.pop("ledger_append", None)
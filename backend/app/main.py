@@ -1,17 +1,131 @@
-from flask import request, jsonify
+from flask import request, jsonify, make_response, g, Response, stream_with_context
 from .config import app, db
-from .models import Users, Categories, Portfolios, Transactions
+from .models import Users, Categories, Transactions, RebalanceReports
+from .encryption_utils import decrypt_stats, monetary_crypto, start_decrypt_stats
+from .schema import ensure_schema
+from .categories import category_registry
+from .batch import BATCH_MAX_OPERATIONS, run_batch
+from .importer import (
+    IMPORT_MAX_ROWS,
+    parse_import_rows,
+    validate_import_rows,
+    import_transactions
+)
+from .history import (
+    fetch_changes,
+    fetch_history_page,
+    iter_transaction_batches,
+    export_csv,
+    export_ndjson,
+    gzip_stream
+)
+from .portfolio import (
+    get_portfolio_snapshot,
+    cached_snapshot_entry,
+    balances_after_write,
+    invalidate_portfolio_cache,
+    summary_cache,
+    dashboard_view,
+    snapshot_view,
+    withdraw_view
+)
+from .ledger import (
+    InsufficientBalanceError,
+    commit_write,
+    record_transaction,
+    remove_transaction
+)
+from .analytics import (
+    GRANULARITIES,
+    TIMESERIES_SOURCE,
+    cashflow_cache,
+    load_transaction_frame,
+    load_snapshot_frame,
+    balance_timeseries,
+    timeseries_payload,
+    get_cashflow,
+    filter_cashflow
+)
+from .rebalance import rebalance_view
+from .events import (
+    EVENTS_KEEPALIVE,
+    STREAM_TICKET_TTL,
+    event_broker,
+    issue_stream_ticket,
+    queue_event,
+    redeem_stream_ticket
+)
+from .token_verifier import get_local_verifier
+from .projection import (
+    PROJECTION_MAX_PATHS,
+    PROJECTION_MAX_YEARS,
+    projection_cache,
+    project_portfolio
+)
 from .helpers import (
     firebase_token_required,
-    serialize_category,
+    firebase_user_required,
+    conditional_on_data_version,
+    bump_data_version,
+    current_data_version,
+    resolve_current_user,
+    invalidate_token_cache,
+    invalidate_user_cache,
+    token_cache,
+    user_cache,
+    serialize_user,
     get_category_data
 )
 from datetime import datetime
+import json
+import time
 
 # Remove CSRF error handler registration since we're using Firebase JWT
 # register_error_handlers(app)
 
 
+@app.before_request
+def reset_decrypt_stats():
+    start_decrypt_stats()
+
+
+# In-process caches reported in the Server-Timing header
+SERVER_TIMING_CACHES = {
+    "decrypt-memo": monetary_crypto.memo,
+    "token-cache": token_cache,
+    "user-cache": user_cache,
+    "summary-cache": summary_cache,
+    "cashflow-cache": cashflow_cache,
+    "projection-cache": projection_cache,
+}
+
+
+@app.after_request
+def report_server_timing(response):
+    """Expose the decrypt cost of the request and the cache counters
+
+    Cache counters are cumulative over the life of the worker process.
+    """
+    if not app.config["SERVER_TIMING"]:
+        return response
+
+    entries = []
+    stats = decrypt_stats.get()
+    if stats and stats["calls"]:
+        entries.append(
+            f'decrypt;dur={stats["seconds"] * 1000:.2f};'
+            f'desc="{stats["calls"]} calls, {stats["memo_hits"]} memo hits"'
+        )
+    for name, cache in SERVER_TIMING_CACHES.items():
+        cache_stats = cache.stats()
+        entries.append(
+            f'{name};desc="{cache_stats["hits"]} hits, {cache_stats["misses"]} misses, '
+            f'{cache_stats["size"]}/{cache_stats["maxsize"]} entries"'
+        )
+    response.headers["Server-Timing"] = ", ".join(entries)
+    return response
+
+
 @app.route("/api/sync-user", methods=["POST"])
 @firebase_token_required
 def sync_user(firebase_uid, user_email):
@@ -27,16 +141,12 @@ def sync_user(firebase_uid, user_email):
             email=user_email,
             name=display_name
         )
+        invalidate_user_cache(firebase_uid)
 
         return jsonify({
             "success": True,
             "message": "Utilisateur synchronisé avec succès",
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "risk_profile": user.risk_profile
-            }
+            "user": serialize_user(user)
         }), 200
 
     except Exception as e:
@@ -57,32 +167,20 @@ def index():
         "description": "Authentication is handled by Firebase on the frontend. All protected routes require Authorization header with Firebase ID token.",
         "endpoints": {
             "user": ["/api/sync-user", "/api/risk-profile"],
-            "portfolio": ["/api/dashboard", "/api/epargne", "/api/immo", "/api/actions", "/api/autres", "/api/invest", "/api/withdraw", "/api/history"],
+            "portfolio": ["/api/portfolio", "/api/portfolio/timeseries", "/api/analytics/cashflow", "/api/projection", "/api/rebalance", "/api/events", "/api/events/ticket", "/api/dashboard", "/api/epargne", "/api/immo", "/api/actions", "/api/autres", "/api/invest", "/api/withdraw", "/api/history", "/api/history/export", "/api/changes", "/api/import", "/api/batch"],
             "account": ["/api/delete-entry", "/api/delete-account"]
         }
     })
 
 
 @app.route("/api/risk-profile", methods=["GET"])
-@firebase_token_required
-def get_risk_profile(firebase_uid, user_email):
+@firebase_user_required
+@conditional_on_data_version
+def get_risk_profile(user):
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        
-        if not user:
-            return jsonify({
-                "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
-        
         return jsonify({
             "success": True,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "risk_profile": user.risk_profile
-            }
+            "user": serialize_user(user)
         }), 200
         
     except Exception as e:
@@ -94,8 +192,8 @@ def get_risk_profile(firebase_uid, user_email):
 
 
 @app.route("/api/risk-profile", methods=["POST"])
-@firebase_token_required
-def update_risk_profile(firebase_uid, user_email):
+@firebase_user_required
+def update_risk_profile(user):
     try:
         if not request.is_json:
             return jsonify({
@@ -119,26 +217,18 @@ def update_risk_profile(firebase_uid, user_email):
                 "message": "Profil de risque invalide"
             }), 400
 
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
-            return jsonify({
-                "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
-
         try:
-            user.risk_profile = risk_profile.lower()
+            Users.query.filter_by(id=user.id).update(
+                {Users.risk_profile: risk_profile.lower()}
+            )
+            bump_data_version(user.id)
             db.session.commit()
+            invalidate_user_cache(user.firebase_uid)
             
             return jsonify({
                 "success": True,
                 "message": "Profil de risque mis à jour avec succès",
-                "user": {
-                    "id": user.id,
-                    "email": user.email,
-                    "username": user.username,
-                    "risk_profile": user.risk_profile
-                }
+                "user": serialize_user(user.replace(risk_profile=risk_profile.lower()))
             }), 200
             
         except Exception as e:
@@ -157,67 +247,156 @@ def update_risk_profile(firebase_uid, user_email):
 
 
 @app.route("/api/dashboard", methods=["GET"])
-@firebase_token_required
-def dashboard(firebase_uid, user_email):
+@firebase_user_required
+@conditional_on_data_version
+def dashboard(user):
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
+        portfolio_summary, total_estate = dashboard_view(
+            get_portfolio_snapshot(user.id, data_version=g.data_version)
+        )
+
+        return jsonify({
+            "success": True,
+            "message": "Données du portefeuille récupérées avec succès",
+            "portfolio_summary": portfolio_summary,
+            "total_estate": total_estate,
+            "user": serialize_user(user)
+        }), 200
+
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
+
+
+@app.route("/api/portfolio", methods=["GET"])
+@firebase_user_required
+@conditional_on_data_version
+def portfolio_snapshot(user):
+    """Whole portfolio tree in one call, optionally limited with ?category="""
+    try:
+        category_names = request.args.getlist("category")
+        snapshot = get_portfolio_snapshot(
+            user.id, category_names or None, data_version=g.data_version
+        )
+
+        return jsonify({
+            "success": True,
+            "message": "Portefeuille récupéré avec succès",
+            "categories": snapshot_view(snapshot),
+            "total_estate": snapshot["total_estate"],
+            "user": serialize_user(user)
+        }), 200
+
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
+
+
+@app.route("/api/portfolio/timeseries", methods=["GET"])
+@firebase_user_required
+@conditional_on_data_version
+def portfolio_timeseries(user):
+    """Balance per category at the end of each day, week or month"""
+    try:
+        granularity = request.args.get("granularity", "day")
+        if granularity not in GRANULARITIES:
             return jsonify({
                 "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
+                "message": "Granularité invalide (day, week ou month)"
+            }), 400
 
-        # Query user balances using ORM objects to properly decrypt
-        portfolio_data = (
-            db.session.query(Portfolios, Categories)
-            .join(Categories, Portfolios.category_id == Categories.id)
-            .filter(Portfolios.user_id == user.id)
-            .all()
-        )
+        try:
+            start, end = (
+                datetime.strptime(request.args[name], "%Y-%m-%d")
+                if request.args.get(name) else None
+                for name in ("start", "end")
+            )
+        except ValueError:
+            return jsonify({
+                "success": False,
+                "message": "Date invalide, format attendu : AAAA-MM-JJ"
+            }), 400
 
-        # Initialize total estate and portfolio summary
-        total_estate = 0
-        portfolio_summary = {}
+        category_names = request.args.getlist("category") or None
+        if TIMESERIES_SOURCE == "snapshots":
+            frame = load_snapshot_frame(user.id, category_names, start=start, end=end)
+        else:
+            frame = load_transaction_frame(user.id, category_names, end=end)
+        balances = balance_timeseries(frame, granularity, start=start)
 
-        for portfolio, category in portfolio_data:
-            balance = portfolio.balance  # This will decrypt automatically
-            category_name = category.category_name
-            sub_category_name = category.sub_category
-            
-            if balance == 0:
-                continue
+        return jsonify({
+            "success": True,
+            "message": "Évolution du portefeuille récupérée avec succès",
+            "granularity": granularity,
+            **timeseries_payload(balances)
+        }), 200
 
-            total_estate += balance
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
 
-            if category_name not in portfolio_summary:
-                portfolio_summary[category_name] = {
-                    "total_balance": 0,
-                    "sub_categories": {},
-                }
 
-            portfolio_summary[category_name]["total_balance"] += balance
+@app.route("/api/analytics/cashflow", methods=["GET"])
+@firebase_user_required
+@conditional_on_data_version
+def cashflow(user):
+    """Monthly deposits, withdrawals and net flow per category"""
+    try:
+        payload = get_cashflow(user.id, data_version=g.data_version)
+        category_names = request.args.getlist("category")
+        if category_names:
+            payload = filter_cashflow(payload, category_names)
+
+        return jsonify({
+            "success": True,
+            "message": "Flux de trésorerie récupérés avec succès",
+            **payload
+        }), 200
+
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
 
-            if sub_category_name not in portfolio_summary[category_name]["sub_categories"]:
-                portfolio_summary[category_name]["sub_categories"][sub_category_name] = 0
-            portfolio_summary[category_name]["sub_categories"][sub_category_name] += balance
 
-        portfolio_summary = {
-            category: details
-            for category, details in portfolio_summary.items()
+@app.route("/api/projection", methods=["GET"])
+@firebase_user_required
+@conditional_on_data_version
+def projection(user):
+    """Monte-Carlo projection of the current allocation, as percentile bands"""
+    try:
+        years = request.args.get("years", 30, type=int)
+        paths = request.args.get("paths", 10000, type=int)
+        if not 1 <= years <= PROJECTION_MAX_YEARS or not 100 <= paths <= PROJECTION_MAX_PATHS:
+            return jsonify({
+                "success": False,
+                "message": f"Horizon de 1 à {PROJECTION_MAX_YEARS} ans et de 100 à {PROJECTION_MAX_PATHS} simulations"
+            }), 400
+
+        snapshot = get_portfolio_snapshot(user.id, data_version=g.data_version)
+        allocation = {
+            category_name: details["total_balance"]
+            for category_name, details in snapshot["categories"].items()
             if details["total_balance"] > 0
         }
 
         return jsonify({
             "success": True,
-            "message": "Données du portefeuille récupérées avec succès",
-            "portfolio_summary": portfolio_summary,
-            "total_estate": total_estate,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "risk_profile": user.risk_profile
-            }
+            "message": "Projection calculée avec succès",
+            "risk_profile": user.risk_profile,
+            "allocation": allocation,
+            **project_portfolio(allocation, user.risk_profile, years=years, paths=paths)
         }), 200
 
     except Exception as e:
@@ -228,16 +407,169 @@ def dashboard(firebase_uid, user_email):
         }), 500
 
 
-@app.route("/api/invest", methods=["GET", "POST"])
-@firebase_token_required
-def invest(firebase_uid, user_email):
-    user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-    if not user:
+@app.route("/api/rebalance", methods=["GET"])
+@firebase_user_required
+def rebalance(user):
+    """Latest rebalancing report computed by `flask rebalance-report`"""
+    try:
+        # Targets follow the current risk profile, maybe changed on another worker
+        user = resolve_current_user(user, current_data_version(user.id))
+        if user is None:
+            return jsonify({
+                "success": False,
+                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
+            }), 404
+
+        report = db.session.get(RebalanceReports, user.id)
+        if not report:
+            return jsonify({
+                "success": False,
+                "message": "Aucun rapport de rééquilibrage disponible"
+            }), 404
+
+        return jsonify({
+            "success": True,
+            "message": "Rapport de rééquilibrage récupéré avec succès",
+            "risk_profile": user.risk_profile,
+            **rebalance_view(report, user.risk_profile)
+        }), 200
+
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
+
+
+@app.route("/api/events/ticket", methods=["POST"])
+@firebase_user_required
+def events_ticket(user):
+    """Single-use ticket for opening /api/events, valid a few seconds"""
+    try:
+        ticket = issue_stream_ticket(
+            user.id, g.token_expires_at or time.time() + 3600
+        )
+        db.session.commit()
+
+        return jsonify({
+            "success": True,
+            "message": "Ticket créé avec succès",
+            "ticket": ticket,
+            "expires_in": STREAM_TICKET_TTL
+        }), 201
+
+    except Exception as e:
+        db.session.rollback()
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
+
+
+def _streams_full():
+    response = jsonify({
+        "success": False,
+        "message": "Trop de flux ouverts sur ce serveur, veuillez réessayer"
+    })
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+
+@app.route("/api/events", methods=["GET"])
+def events():
+    """Server-Sent Events: balance deltas of the user's committed writes
+
+    Open with ?ticket= from POST /api/events/ticket: EventSource cannot send
+    the Authorization header. Events are "balances" ({"deltas": [...],
+    "total_delta"}) and "resync", sent when events may have been missed and
+    the client should refetch. The stream ends with "expired" when the ID
+    token the ticket was issued for expires, and with "closed" when the
+    account is deleted; reconnect with a new ticket.
+    """
+    # Each stream holds a worker thread: refuse before using the ticket
+    if event_broker.is_full():
+        return _streams_full()
+
+    try:
+        ticket = request.args.get("ticket")
+        redeemed = redeem_stream_ticket(ticket) if ticket else None
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Exception occurred: {str(e)}")
         return jsonify({
             "success": False,
-            "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-        }), 404
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
+
+    if redeemed is None:
+        return jsonify({
+            "success": False,
+            "message": "Ticket invalide ou expiré"
+        }), 401
+
+    user_id, stream_expires_at = redeemed
+    subscription = event_broker.subscribe(user_id)
+    if subscription is None:
+        return _streams_full()
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                remaining = (stream_expires_at - datetime.utcnow()).total_seconds()
+                if remaining <= 0:
+                    yield 'event: expired\ndata: {"type": "expired"}\n\n'
+                    return
+                event = subscription.get(timeout=min(EVENTS_KEEPALIVE, remaining))
+                if event is None:
+                    # Comment line: keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                if event["type"] == "closed":
+                    return
+        finally:
+            subscription.close()
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _add_balances(response, user_id, base_entry, version, exclusive,
+                  category_name, sub_category, delta):
+    """Fill response["balances"] for ?include=balances after a committed write
+
+    The write is already committed: if the balances can't be computed, the
+    response stays a success and carries "refetch": true instead, so that a
+    client never retries (and repeats) the write. It always does when the
+    data version wasn't bumped: the client must then reload without
+    If-None-Match, as the previous ETags still match.
+    """
+    if version is None:
+        response["refetch"] = True
+        return
+    if request.args.get("include") != "balances":
+        return
+    try:
+        response["balances"] = balances_after_write(
+            user_id, base_entry if exclusive else None, version,
+            category_name, sub_category, delta
+        )
+    except Exception as e:
+        db.session.rollback()
+        print(f"Exception occurred: {str(e)}")
+        response["refetch"] = True
 
+
+@app.route("/api/invest", methods=["GET", "POST"])
+@firebase_user_required
+def invest(user):
     if request.method == "POST":
         try:
             if not request.is_json:
@@ -250,7 +582,6 @@ def invest(firebase_uid, user_email):
             category_name = data.get("categoryName")
             sub_category = data.get("subCategory")
             amount = data.get("amount")
-            timestamp = datetime.utcnow()
 
             try:
                 amount = float(amount)
@@ -271,42 +602,17 @@ def invest(firebase_uid, user_email):
                     "message": "La catégorie et la sous-catégorie sont requises"
                 }), 400
 
-            category_query = Categories.query.filter_by(
-                category_name=category_name, sub_category=sub_category
-            ).first()
-            if not category_query:
+            category_id = category_registry.get_id(category_name, sub_category)
+            if category_id is None:
                 return jsonify({
                     "success": False,
                     "message": "Cette combinaison de catégorie et de sous-catégorie n'existe pas"
                 }), 400
 
-            category_id = category_query.id
-            new_entry = Transactions(
-                user_id=user.id,
-                category_id=category_id,
-                amount=amount,
-                timestamp=timestamp,
-            )
-            
             try:
-                db.session.add(new_entry)
-
-                portfolio = Portfolios.query.filter_by(
-                    user_id=user.id, category_id=category_id
-                ).first()
-                if portfolio:
-                    portfolio.balance += amount
-                else:
-                    portfolio = Portfolios(
-                        user_id=user.id, category_id=category_id, balance=amount
-                    )
-                    db.session.add(portfolio)
-
-                db.session.commit()
-                return jsonify({
-                    "success": True,
-                    "message": "Investissement ajouté avec succès"
-                }), 201
+                base_entry = cached_snapshot_entry(user.id)
+                record_transaction(user.id, category_id, amount)
+                version, exclusive = commit_write(user.id)
 
             except Exception as e:
                 db.session.rollback()
@@ -314,6 +620,17 @@ def invest(firebase_uid, user_email):
                     "success": False,
                     "message": f"Une erreur s'est produite lors de l'ajout de l'entrée: {str(e)}"
                 }), 500
+
+            response = {
+                "success": True,
+                "message": "Investissement ajouté avec succès"
+            }
+            # ?include=balances: new balances, saving a refetch
+            _add_balances(
+                response, user.id, base_entry, version, exclusive,
+                category_name, sub_category, amount
+            )
+            return jsonify(response), 201
                 
         except Exception as e:
             print(f"Exception occurred: {str(e)}")
@@ -322,19 +639,21 @@ def invest(firebase_uid, user_email):
                 "message": f"Erreur serveur: {str(e)}"
             }), 500
 
-    # GET request
+    # GET request - categories are served from the in-memory registry
     try:
-        distinct_categories = (
-            Categories.query.with_entities(Categories.category_name).distinct().all()
-        )
-        all_categories = [serialize_category(cat) for cat in Categories.query.all()]
+        etag = category_registry.etag
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
 
-        return jsonify({
+        response = make_response(jsonify({
             "success": True,
             "message": "Catégories récupérées avec succès",
-            "distinct_categories": [cat.category_name for cat in distinct_categories],
-            "all_categories": all_categories
-        }), 200
+            **category_registry.payload
+        }), 200)
+        response.set_etag(etag)
+        return response
 
     except Exception as e:
         print(f"Exception occurred: {str(e)}")
@@ -344,16 +663,133 @@ def invest(firebase_uid, user_email):
         }), 500
 
 
-@app.route("/api/withdraw", methods=["GET", "POST"])
-@firebase_token_required
-def withdraw(firebase_uid, user_email):
-    user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-    if not user:
+@app.route("/api/import", methods=["POST"])
+@firebase_user_required
+def import_history(user):
+    """Record many past transactions in one request and one transaction"""
+    try:
+        try:
+            rows = parse_import_rows(request)
+        except (ValueError, UnicodeDecodeError) as e:
+            return jsonify({
+                "success": False,
+                "message": str(e) if isinstance(e, ValueError) else "Fichier illisible"
+            }), 400
+
+        if not rows:
+            return jsonify({
+                "success": False,
+                "message": "Aucune transaction à importer"
+            }), 400
+
+        if len(rows) > IMPORT_MAX_ROWS:
+            return jsonify({
+                "success": False,
+                "message": f"Import limité à {IMPORT_MAX_ROWS} transactions"
+            }), 400
+
+        entries, errors = validate_import_rows(rows)
+        if errors:
+            return jsonify({
+                "success": False,
+                "message": "Certaines lignes sont invalides, rien n'a été importé",
+                "errors": errors
+            }), 400
+
+        try:
+            import_transactions(user.id, entries)
+            db.session.commit()
+
+        except InsufficientBalanceError as e:
+            db.session.rollback()
+            category_name, sub_category = category_registry.get_names(e.category_id)
+            return jsonify({
+                "success": False,
+                "message": f"Solde insuffisant pour {category_name} / {sub_category}, rien n'a été importé"
+            }), 400
+
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({
+                "success": False,
+                "message": f"Une erreur s'est produite lors de l'import: {str(e)}"
+            }), 500
+
+        return jsonify({
+            "success": True,
+            "message": f"{len(entries)} transactions importées avec succès",
+            "imported": len(entries)
+        }), 201
+
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
         return jsonify({
             "success": False,
-            "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-        }), 404
-    
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
+
+
+@app.route("/api/batch", methods=["POST"])
+@firebase_user_required
+def batch(user):
+    """Apply several invest / withdraw / delete_entry operations atomically"""
+    try:
+        if not request.is_json:
+            return jsonify({
+                "success": False,
+                "message": "Content-Type must be application/json"
+            }), 400
+
+        operations = (request.get_json() or {}).get("operations")
+        if not isinstance(operations, list) or not operations:
+            return jsonify({
+                "success": False,
+                "message": "Une liste d'opérations est requise"
+            }), 400
+
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            return jsonify({
+                "success": False,
+                "message": f"Limité à {BATCH_MAX_OPERATIONS} opérations par requête"
+            }), 400
+
+        try:
+            results, ok = run_batch(user.id, operations)
+            if not ok:
+                db.session.rollback()
+                return jsonify({
+                    "success": False,
+                    "message": "Certaines opérations ont échoué, aucune n'a été appliquée",
+                    "results": results
+                }), 400
+
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({
+                "success": False,
+                "message": f"Une erreur s'est produite lors de l'enregistrement: {str(e)}"
+            }), 500
+
+        return jsonify({
+            "success": True,
+            "message": "Opérations effectuées avec succès",
+            "results": results
+        }), 200
+
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
+
+
+@app.route("/api/withdraw", methods=["GET", "POST"])
+@firebase_user_required
+@conditional_on_data_version
+def withdraw(user):
     if request.method == "POST":
         try:
             if not request.is_json:
@@ -380,48 +816,25 @@ def withdraw(firebase_uid, user_email):
                     "message": "Entrée invalide. Veuillez réessayer"
                 }), 400
 
-            category_query = (
-                db.session.query(Categories)
-                .filter_by(category_name=category_name, sub_category=sub_category_name)
-                .first()
-            )
-            if not category_query:
+            category_id = category_registry.get_id(category_name, sub_category_name)
+            if category_id is None:
                 return jsonify({
                     "success": False,
                     "message": "Cette combinaison de catégorie et de sous-catégorie n'existe pas"
                 }), 400
 
-            category_id = category_query.id
-
-            portfolio_entry = (
-                db.session.query(Portfolios)
-                .filter_by(user_id=user.id, category_id=category_id)
-                .first()
-            )
+            try:
+                base_entry = cached_snapshot_entry(user.id)
+                record_transaction(user.id, category_id, -withdraw_amount)
+                version, exclusive = commit_write(user.id)
 
-            if not portfolio_entry or portfolio_entry.balance < withdraw_amount:
+            except InsufficientBalanceError:
+                db.session.rollback()
                 return jsonify({
                     "success": False,
                     "message": "Solde insuffisant pour effectuer ce retrait"
                 }), 400
 
-            portfolio_entry.balance -= withdraw_amount
-
-            withdrawal_transaction = Transactions(
-                user_id=user.id,
-                category_id=category_id,
-                amount=-withdraw_amount,
-                timestamp=datetime.utcnow(),
-            )
-
-            try:
-                db.session.add(withdrawal_transaction)
-                db.session.commit()
-                return jsonify({
-                    "success": True,
-                    "message": "Retrait effectué avec succès"
-                }), 201
-
             except Exception as e:
                 db.session.rollback()
                 return jsonify({
@@ -429,6 +842,16 @@ def withdraw(firebase_uid, user_email):
                     "message": f"Une erreur s'est produite lors de l'enregistrement du retrait: {str(e)}"
                 }), 500
 
+            response = {
+                "success": True,
+                "message": "Retrait effectué avec succès"
+            }
+            _add_balances(
+                response, user.id, base_entry, version, exclusive,
+                category_name, sub_category_name, -withdraw_amount
+            )
+            return jsonify(response), 201
+
         except Exception as e:
             print(f"Exception occurred: {str(e)}")
             return jsonify({
@@ -438,30 +861,10 @@ def withdraw(firebase_uid, user_email):
     
     # GET request
     try:
-        # GET request - use ORM objects to properly decrypt balances
-        withdraw_categories = (
-            db.session.query(Categories, Portfolios)
-            .join(Portfolios, Categories.id == Portfolios.category_id)
-            .filter(Portfolios.user_id == user.id)
-            .all()
+        withdraw_categories_data, distinct_categories = withdraw_view(
+            get_portfolio_snapshot(user.id, data_version=g.data_version)
         )
 
-        # Filter out zero balances and prepare data
-        withdraw_categories_data = []
-        distinct_categories = set()
-        
-        for category, portfolio in withdraw_categories:
-            balance = portfolio.balance  # This will decrypt automatically
-            if balance > 0:
-                withdraw_categories_data.append({
-                    "category": category.category_name,
-                    "sub_category": category.sub_category,
-                    "balance": balance,
-                })
-                distinct_categories.add(category.category_name)
-
-        distinct_categories = sorted(list(distinct_categories))
-
         return jsonify({
             "success": True,
             "message": "Catégories de retrait récupérées avec succès",
@@ -478,18 +881,36 @@ def withdraw(firebase_uid, user_email):
 
 
 @app.route("/api/history", methods=['GET'])
-@firebase_token_required
-def view_history(firebase_uid, user_email):
+@firebase_user_required
+@conditional_on_data_version
+def view_history(user):
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
+        per_page = min(request.args.get('per_page', 10, type=int), 100)
+
+        # Keyset pagination: ?cursor= (empty for the first page), then the
+        # returned next_cursor. ?page= keeps the legacy offset pagination.
+        if "cursor" in request.args:
+            try:
+                transaction_history, pagination = fetch_history_page(
+                    user.id,
+                    cursor=request.args.get("cursor"),
+                    per_page=per_page,
+                    include_total=request.args.get("include_total") == "1"
+                )
+            except ValueError:
+                return jsonify({
+                    "success": False,
+                    "message": "Curseur invalide"
+                }), 400
+
             return jsonify({
-                "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
+                "success": True,
+                "message": "Historique des transactions récupéré avec succès",
+                "transaction_history": transaction_history,
+                "pagination": pagination
+            }), 200
 
         page = request.args.get('page', 1, type=int)
-        per_page = min(request.args.get('per_page', 10, type=int), 100)
 
         pagination = (
             db.session.query(
@@ -499,7 +920,8 @@ def view_history(firebase_uid, user_email):
             )
             .join(Categories, Transactions.category_id == Categories.id)
             .filter(Transactions.user_id == user.id)
-            .order_by(Transactions.timestamp.desc())
+            # Same order as the keyset path: undated transactions last
+            .order_by(Transactions.timestamp.desc().nulls_last(), Transactions.id.desc())
             .paginate(page=page, per_page=per_page, error_out=False)
         )
 
@@ -524,7 +946,10 @@ def view_history(firebase_uid, user_email):
                 "category_name": entry.category_name,
                 "sub_category_name": entry.sub_category_name,
                 "amount": entry.Transactions.amount,
-                "timestamp": entry.Transactions.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                "timestamp": (
+                    entry.Transactions.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+                    if entry.Transactions.timestamp else None
+                ),
             }
             for entry in pagination.items
         ]
@@ -551,17 +976,124 @@ def view_history(firebase_uid, user_email):
         }), 500
 
 
-@app.route("/api/delete-entry", methods=["DELETE", "POST"])
-@firebase_token_required
-def delete_entry(firebase_uid, user_email):
+@app.route("/api/changes", methods=['GET'])
+@firebase_user_required
+@conditional_on_data_version
+def changes(user):
+    """Transactions, deletions and balances changed after ?since=<version>
+
+    Start from the X-Data-Version header of a full load; the response
+    carries the version for the next call. When the client's version is
+    unknown or too far behind, full_resync tells it to reload everything.
+    """
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
+        since = request.args.get("since", type=int)
+        if since is None or since < 0:
             return jsonify({
                 "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
+                "message": "Paramètre since invalide"
+            }), 400
+
+        version = g.data_version
+        result = fetch_changes(user.id, since, version) if since <= version else None
+        if result is None:
+            return jsonify({
+                "success": True,
+                "message": "Rechargement complet nécessaire",
+                "version": version,
+                "full_resync": True
+            }), 200
+
+        transactions, deleted_ids, category_ids = result
+        snapshot = get_portfolio_snapshot(user.id, data_version=version)
+        balances = []
+        for category_id in sorted(category_ids):
+            category_name, sub_category = category_registry.get_names(category_id)
+            details = snapshot["categories"].get(category_name, {})
+            balances.append({
+                "category_name": category_name,
+                "sub_category": sub_category,
+                "balance": details.get("sub_categories", {}).get(sub_category, 0),
+                "category_total": details.get("total_balance", 0)
+            })
+
+        return jsonify({
+            "success": True,
+            "message": "Modifications récupérées avec succès",
+            "version": version,
+            "full_resync": False,
+            "transactions": transactions,
+            "deleted": deleted_ids,
+            "balances": balances,
+            "total_estate": snapshot["total_estate"]
+        }), 200
+
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
 
+
+@app.route("/api/history/export", methods=['GET'])
+@firebase_user_required
+def export_history(user):
+    """Stream the whole history as CSV or NDJSON, optionally gzip-compressed"""
+    try:
+        export_format = request.args.get("format", "csv")
+        if export_format not in ("csv", "ndjson"):
+            return jsonify({
+                "success": False,
+                "message": "Format d'export invalide"
+            }), 400
+
+        try:
+            start, end = (
+                datetime.strptime(request.args[name], "%Y-%m-%d")
+                if request.args.get(name) else None
+                for name in ("start", "end")
+            )
+        except ValueError:
+            return jsonify({
+                "success": False,
+                "message": "Date invalide, format attendu : AAAA-MM-JJ"
+            }), 400
+
+        batches = iter_transaction_batches(
+            user.id, start=start, end=end,
+            category_names=request.args.getlist("category") or None
+        )
+        if export_format == "csv":
+            chunks, mimetype = export_csv(batches), "text/csv"
+        else:
+            chunks, mimetype = export_ndjson(batches), "application/x-ndjson"
+
+        headers = {
+            "Content-Disposition": f"attachment; filename=historique.{export_format}"
+        }
+        if request.args.get("gzip") == "1":
+            chunks = gzip_stream(chunks)
+            headers["Content-Encoding"] = "gzip"
+
+        return Response(
+            stream_with_context(chunks),
+            mimetype=mimetype,
+            headers=headers
+        )
+
+    except Exception as e:
+        print(f"Exception occurred: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"Erreur serveur: {str(e)}"
+        }), 500
+
+
+@app.route("/api/delete-entry", methods=["DELETE", "POST"])
+@firebase_user_required
+def delete_entry(user):
+    try:
         if not request.is_json:
             return jsonify({
                 "success": False,
@@ -587,25 +1119,13 @@ def delete_entry(firebase_uid, user_email):
                 "message": "Transaction introuvable ou vous n'avez pas l'autorisation de la supprimer"
             }), 404
 
-        portfolio_entry = Portfolios.query.filter_by(
-            user_id=user.id, category_id=transaction.category_id
-        ).first()
-
-        if not portfolio_entry:
-            return jsonify({
-                "success": False,
-                "message": "Entrée de portefeuille introuvable"
-            }), 404
+        category_name, sub_category = category_registry.get_names(transaction.category_id)
+        amount = transaction.amount
 
         try:
-            portfolio_entry.balance -= transaction.amount
-            db.session.delete(transaction)
-            db.session.commit()
-
-            return jsonify({
-                "success": True,
-                "message": "Transaction supprimée avec succès"
-            }), 200
+            base_entry = cached_snapshot_entry(user.id)
+            remove_transaction(user.id, transaction)
+            version, exclusive = commit_write(user.id)
 
         except Exception as e:
             db.session.rollback()
@@ -614,6 +1134,16 @@ def delete_entry(firebase_uid, user_email):
                 "message": f"Une erreur s'est produite lors de la suppression: {str(e)}"
             }), 500
 
+        response = {
+            "success": True,
+            "message": "Transaction supprimée avec succès"
+        }
+        _add_balances(
+            response, user.id, base_entry, version, exclusive,
+            category_name, sub_category, -amount
+        )
+        return jsonify(response), 200
+
     except Exception as e:
         print(f"Exception occurred: {str(e)}")
         return jsonify({
@@ -624,29 +1154,20 @@ def delete_entry(firebase_uid, user_email):
 
 
 @app.route("/api/epargne", methods=["GET"])
-@firebase_token_required
-def epargne(firebase_uid, user_email):
+@firebase_user_required
+@conditional_on_data_version
+def epargne(user):
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
-            return jsonify({
-                "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
-
-        epargne_summary, total_epargne = get_category_data(user.id, "Épargne")
+        epargne_summary, total_epargne = get_category_data(
+            user.id, "Épargne", data_version=g.data_version
+        )
 
         return jsonify({
             "success": True,
             "message": "Données d'épargne récupérées avec succès",
             "epargne_summary": epargne_summary,
             "total_epargne": total_epargne,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "risk_profile": user.risk_profile
-            }
+            "user": serialize_user(user)
         }), 200
 
     except Exception as e:
@@ -658,29 +1179,20 @@ def epargne(firebase_uid, user_email):
 
 
 @app.route("/api/immo", methods=["GET"])
-@firebase_token_required
-def immo(firebase_uid, user_email):
+@firebase_user_required
+@conditional_on_data_version
+def immo(user):
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
-            return jsonify({
-                "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
-
-        immo_summary, total_immo = get_category_data(user.id, "Immobilier")
+        immo_summary, total_immo = get_category_data(
+            user.id, "Immobilier", data_version=g.data_version
+        )
 
         return jsonify({
             "success": True,
             "message": "Données immobilières récupérées avec succès",
             "immo_summary": immo_summary,
             "total_immo": total_immo,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "risk_profile": user.risk_profile
-            }
+            "user": serialize_user(user)
         }), 200
 
     except Exception as e:
@@ -692,29 +1204,20 @@ def immo(firebase_uid, user_email):
 
 
 @app.route("/api/actions", methods=["GET"])
-@firebase_token_required
-def actions(firebase_uid, user_email):
+@firebase_user_required
+@conditional_on_data_version
+def actions(user):
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
-            return jsonify({
-                "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
-
-        actions_summary, total_actions = get_category_data(user.id, "Actions")
+        actions_summary, total_actions = get_category_data(
+            user.id, "Actions", data_version=g.data_version
+        )
 
         return jsonify({
             "success": True,
             "message": "Données actions récupérées avec succès",
             "actions_summary": actions_summary,
             "total_actions": total_actions,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "risk_profile": user.risk_profile
-            }
+            "user": serialize_user(user)
         }), 200
 
     except Exception as e:
@@ -726,29 +1229,20 @@ def actions(firebase_uid, user_email):
 
 
 @app.route("/api/autres", methods=["GET"])
-@firebase_token_required
-def autres(firebase_uid, user_email):
+@firebase_user_required
+@conditional_on_data_version
+def autres(user):
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
-            return jsonify({
-                "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
-
-        autres_summary, total_autres = get_category_data(user.id, "Autres")
+        autres_summary, total_autres = get_category_data(
+            user.id, "Autres", data_version=g.data_version
+        )
 
         return jsonify({
             "success": True,
             "message": "Données autres récupérées avec succès",
             "autres_summary": autres_summary,
             "total_autres": total_autres,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "risk_profile": user.risk_profile
-            }
+            "user": serialize_user(user)
         }), 200
 
     except Exception as e:
@@ -760,20 +1254,28 @@ def autres(firebase_uid, user_email):
 
 
 @app.route("/api/delete-account", methods=["POST"])
-@firebase_token_required
-def delete_account(firebase_uid, user_email):
+@firebase_user_required
+def delete_account(user):
     try:
-        user = Users.query.filter_by(firebase_uid=firebase_uid).first()
-        if not user:
-            return jsonify({
-                "success": False,
-                "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
-            }), 404
-        
         try:
+            account = db.session.get(Users, user.id)
+            if account is None:
+                # Already deleted, e.g. through another worker whose cached
+                # record this one still had
+                invalidate_user_cache(user.firebase_uid)
+                return jsonify({
+                    "success": False,
+                    "message": "Utilisateur non trouvé. Veuillez vous reconnecter."
+                }), 404
+
             # Delete user with cascade to portfolios and transactions
-            db.session.delete(user)
+            db.session.delete(account)
+            # Ends the user's open /api/events streams
+            queue_event(user.id, {"type": "closed"})
             db.session.commit()
+            invalidate_portfolio_cache(user.id)
+            invalidate_user_cache(user.firebase_uid)
+            invalidate_token_cache(firebase_uid=user.firebase_uid)
 
             return jsonify({
                 "success": True,
@@ -795,9 +1297,13 @@ def delete_account(firebase_uid, user_email):
         }), 500
 
 
+# Register CLI commands (flask --app backend.app.main <command>)
+from . import commands
+
 # Instantiate db
 with app.app_context():
     db.create_all()
+    ensure_schema()
 
     # Insert default categories if Categories table is empty
     if Categories.query.count() == 0:
@@ -825,6 +1331,25 @@ with app.app_context():
         db.session.bulk_save_objects(default_categories)
         db.session.commit()
 
+    category_registry.reload()
+
+
+def after_fork():
+    """Reset what a worker forked from a preloaded app must not share
+
+    Called by gunicorn's post_fork hook. Pooled connections opened by the
+    parent are dropped without closing them (the parent still owns the
+    sockets). Locks and background threads inherited from the parent are
+    reset; the threads start again on first use (signing key refresh on
+    the first token check, events listener on the first subscription).
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+    verifier = get_local_verifier()
+    if verifier is not None:
+        verifier.key_store.after_fork()
+    event_broker.reset()
+
 
 if __name__ == "__main__":
     app.run(debug=True)
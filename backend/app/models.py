@@ -10,10 +10,16 @@ class Users(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=True)  # Keep for backward compatibility
     risk_profile = db.Column(db.String(80), nullable=False, default="équilibré")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped by every write to the user's data; drives ETags on read endpoints
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     
     # Relationships
     portfolios = db.relationship('Portfolios', backref='user', lazy=True, cascade='all, delete-orphan')
     transactions = db.relationship('Transactions', backref='user', lazy=True, cascade='all, delete-orphan')
+    portfolio_snapshots = db.relationship('PortfolioSnapshots', backref='user', lazy=True, cascade='all, delete-orphan')
+    deleted_transactions = db.relationship('DeletedTransactions', backref='user', lazy=True, cascade='all, delete-orphan')
+    rebalance_report = db.relationship('RebalanceReports', backref='user', lazy=True, uselist=False, cascade='all, delete-orphan')
+    stream_tickets = db.relationship('StreamTickets', backref='user', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<User {self.email}>'
@@ -47,18 +53,30 @@ class Portfolios(db.Model):
     category_id = db.Column(
         db.Integer, db.ForeignKey("categories.id"), primary_key=True
     )
-    balance_encrypted = db.Column(db.Text, nullable=False, default="")
+    # Legacy base64(Fernet) text, kept readable until migrate-amounts runs
+    balance_encrypted = db.Column(db.Text, nullable=True)
+    balance_ciphertext = db.Column(db.LargeBinary, nullable=True)
+    # Last transaction folded into the stored balance (see ledger.py)
+    checkpoint_transaction_id = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+
+    @property
+    def stored_balance(self):
+        """Raw stored ciphertext, whichever format it is in"""
+        return self.balance_ciphertext or self.balance_encrypted
     
     # Property to handle encryption/decryption transparently
     @property
     def balance(self):
-        if not self.balance_encrypted:
+        if not self.stored_balance:
             return 0.0
-        return monetary_crypto.decrypt_amount(self.balance_encrypted)
+        return monetary_crypto.decrypt_amount(self.stored_balance)
     
     @balance.setter
     def balance(self, value: float):
-        self.balance_encrypted = monetary_crypto.encrypt_amount(value)
+        self.balance_ciphertext = monetary_crypto.encrypt_amount(value)
+        self.balance_encrypted = None
 
 
 class Transactions(db.Model):
@@ -67,14 +85,100 @@ class Transactions(db.Model):
     category_id = db.Column(
         db.Integer, db.ForeignKey("categories.id"), nullable=False
         )
-    amount_encrypted = db.Column(db.Text, nullable=False)
+    # Legacy base64(Fernet) text, kept readable until migrate-amounts runs
+    amount_encrypted = db.Column(db.Text, nullable=True)
+    amount_ciphertext = db.Column(db.LargeBinary, nullable=True)
     timestamp = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    # Users.data_version of the commit that inserted the row; stamped by
+    # mark_portfolio_changed(), NULL until then
+    version = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        # Serves history pages newest first, see history.fetch_history_page()
+        db.Index(
+            "ix_transactions_user_timestamp_id",
+            user_id, timestamp.desc(), id.desc()
+        ),
+        # Ledger tails: transactions above a category's checkpoint
+        db.Index("ix_transactions_user_category_id", user_id, category_id, id),
+        # Delta sync, see /api/changes
+        db.Index("ix_transactions_user_version", user_id, version),
+    )
+
+    @property
+    def stored_amount(self):
+        """Raw stored ciphertext, whichever format it is in"""
+        return self.amount_ciphertext or self.amount_encrypted
 
     # Property to handle encryption/decryption transparently
     @property
     def amount(self):
-        return monetary_crypto.decrypt_amount(self.amount_encrypted)
+        return monetary_crypto.decrypt_amount(self.stored_amount)
     
     @amount.setter
     def amount(self, value: float):
-        self.amount_encrypted = monetary_crypto.encrypt_amount(value)
\ No newline at end of file
+        self.amount_ciphertext = monetary_crypto.encrypt_amount(value)
+        self.amount_encrypted = None
+
+
+# Closing balance of a category on each day it changed, see snapshots.py
+class PortfolioSnapshots(db.Model):
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id"), primary_key=True
+    )
+    category_id = db.Column(
+        db.Integer, db.ForeignKey("categories.id"), primary_key=True
+    )
+    day = db.Column(db.Date, primary_key=True)
+    balance_ciphertext = db.Column(db.LargeBinary, nullable=False)
+
+    @property
+    def balance(self):
+        return monetary_crypto.decrypt_amount(self.balance_ciphertext)
+
+    @balance.setter
+    def balance(self, value: float):
+        self.balance_ciphertext = monetary_crypto.encrypt_amount(value)
+
+
+# Latest allocation drift of each user, written by `flask rebalance-report`
+class RebalanceReports(db.Model):
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id"), primary_key=True
+    )
+    risk_profile = db.Column(db.String(80), nullable=False)
+    # JSON {category_name: actual weight}
+    weights = db.Column(db.Text, nullable=False)
+    max_drift = db.Column(db.Float, nullable=False)
+    total_ciphertext = db.Column(db.LargeBinary, nullable=False)
+    generated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @property
+    def total(self):
+        return monetary_crypto.decrypt_amount(self.total_ciphertext)
+
+
+# Tombstone of a deleted transaction, so /api/changes can report deletions
+class DeletedTransactions(db.Model):
+    # Id of the deleted transaction
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    category_id = db.Column(
+        db.Integer, db.ForeignKey("categories.id"), nullable=False
+    )
+    version = db.Column(db.Integer, nullable=True)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_deleted_transactions_user_version", user_id, version),
+    )
+
+
+# Single-use ticket opening one /api/events stream, see events.py
+class StreamTickets(db.Model):
+    # SHA-256 of the ticket; the ticket itself is only known to the client
+    id = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    # Expiry of the ID token the ticket was issued for; the stream ends then
+    stream_expires_at = db.Column(db.DateTime, nullable=False)
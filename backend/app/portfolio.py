@@ -0,0 +1,284 @@
+import os
+import threading
+from sqlalchemy import and_, event, func, select, update
+from .config import db
+from .models import DeletedTransactions, Portfolios, Transactions
+from .encryption_utils import monetary_crypto
+from .categories import category_registry
+from .cache_utils import BoundedTTLCache
+from .helpers import bump_data_version
+
+# "balance": every write locks the Portfolios row and rewrites the balance.
+# "ledger": investments only append to Transactions; balances are folded in
+# by write paths that need the exact balance and by `flask compact-ledger`.
+# Run compact-ledger before switching from "ledger" back to "balance": in
+# balance mode, snapshot reads skip the ledger tails.
+WRITE_MODE = os.environ.get('PORTFOLIO_WRITE_MODE', 'balance')
+
+# user_id -> (data_version, full portfolio snapshot), dropped whenever a
+# commit changes it
+summary_cache = BoundedTTLCache(
+    maxsize=int(os.environ.get('SUMMARY_CACHE_SIZE', 2048))
+)
+
+# Bumped on every invalidation; a snapshot built while it moved may be stale
+_invalidation_epoch = 0
+_epoch_lock = threading.Lock()
+
+
+def tail_amounts(user_id, category_ids=None):
+    """Net amount of the transactions appended after each row's checkpoint
+
+    A balance is the stored (checkpoint) balance plus this tail; see
+    ledger.py. Returns {category_id: amount} for categories with a tail.
+    """
+    query = (
+        select(
+            Transactions.category_id,
+            Transactions.amount_ciphertext,
+            Transactions.amount_encrypted,
+        )
+        .outerjoin(Portfolios, and_(
+            Portfolios.user_id == Transactions.user_id,
+            Portfolios.category_id == Transactions.category_id,
+        ))
+        .where(
+            Transactions.user_id == user_id,
+            Transactions.id > func.coalesce(Portfolios.checkpoint_transaction_id, 0),
+        )
+    )
+    if category_ids is not None:
+        query = query.where(Transactions.category_id.in_(sorted(category_ids)))
+
+    rows = db.session.execute(query).all()
+    amounts = monetary_crypto.decrypt_many(compact or legacy for _, compact, legacy in rows)
+
+    tails = {}
+    for (category_id, _, _), amount in zip(rows, amounts):
+        tails[category_id] = tails.get(category_id, 0.0) + amount
+    return tails
+
+
+def build_portfolio_snapshot(user_id, category_names=None):
+    """Aggregate a user's balances into the category tree
+
+    Returns {"categories": {name: {"total_balance", "sub_categories"}},
+    "total_estate"}. Zero balances are left out; every other balance,
+    including a negative one, counts towards the totals.
+
+    Balances are read as plain rows, without building Portfolios objects or
+    joining Categories: names come from the category registry.
+    """
+    query = (
+        select(
+            Portfolios.category_id,
+            Portfolios.balance_ciphertext,
+            Portfolios.balance_encrypted,
+        )
+        .where(Portfolios.user_id == user_id)
+    )
+    if category_names:
+        query = query.where(
+            Portfolios.category_id.in_(category_registry.get_ids(category_names))
+        )
+    rows = db.session.execute(query).all()
+
+    # Decrypt every balance in one pass
+    balances = monetary_crypto.decrypt_many(
+        compact or legacy for _, compact, legacy in rows
+    )
+    # Balance mode folds every write into the stored balance: no tails
+    tails = tail_amounts(user_id) if WRITE_MODE == "ledger" else {}
+
+    total_estate = 0
+    categories = {}
+
+    for (category_id, _, _), balance in zip(rows, balances):
+        names = category_registry.get_names(category_id)
+        if names is None:
+            continue
+        category_name, sub_category = names
+
+        balance = round(balance + tails.get(category_id, 0.0), 2)
+        if balance == 0:
+            continue
+
+        total_estate += balance
+
+        details = categories.setdefault(category_name, {
+            "total_balance": 0,
+            "sub_categories": {},
+        })
+        details["total_balance"] += balance
+        sub_categories = details["sub_categories"]
+        sub_categories[sub_category] = sub_categories.get(sub_category, 0) + balance
+
+    # Rounded like apply_snapshot_delta(), so derived and rebuilt snapshots match
+    for details in categories.values():
+        details["total_balance"] = round(details["total_balance"], 2)
+    return {"categories": categories, "total_estate": round(total_estate, 2)}
+
+
+def get_portfolio_snapshot(user_id, category_names=None, data_version=None):
+    """Cached version of build_portfolio_snapshot()
+
+    When data_version is given, a cached snapshot built for another version
+    (e.g. before a write handled by another worker) is rebuilt.
+    """
+    entry = summary_cache.get(user_id)
+    if entry is not None and (data_version is None or entry[0] == data_version):
+        snapshot = entry[1]
+    else:
+        epoch = _invalidation_epoch
+        snapshot = build_portfolio_snapshot(user_id)
+        # Don't cache a snapshot that may predate a concurrent commit
+        if epoch == _invalidation_epoch:
+            summary_cache.set(user_id, (data_version, snapshot))
+
+    if category_names:
+        return filter_snapshot(snapshot, category_names)
+    return snapshot
+
+
+def filter_snapshot(snapshot, category_names):
+    """Restrict a snapshot to some categories and recompute the total"""
+    categories = {
+        category_name: details
+        for category_name, details in snapshot["categories"].items()
+        if category_name in category_names
+    }
+    total_estate = sum(details["total_balance"] for details in categories.values())
+    return {"categories": categories, "total_estate": round(total_estate, 2)}
+
+
+def apply_snapshot_delta(snapshot, category_name, sub_category, delta):
+    """Copy of a snapshot with one sub-category balance moved by delta"""
+    categories = dict(snapshot["categories"])
+    details = categories.get(category_name, {"total_balance": 0, "sub_categories": {}})
+    sub_categories = dict(details["sub_categories"])
+
+    balance = round(sub_categories.get(sub_category, 0) + delta, 2)
+    if balance:
+        sub_categories[sub_category] = balance
+    else:
+        sub_categories.pop(sub_category, None)
+
+    if sub_categories:
+        categories[category_name] = {
+            "total_balance": round(details["total_balance"] + delta, 2),
+            "sub_categories": sub_categories,
+        }
+    else:
+        categories.pop(category_name, None)
+
+    return {
+        "categories": categories,
+        "total_estate": round(snapshot["total_estate"] + delta, 2),
+    }
+
+
+def cached_snapshot_entry(user_id):
+    """(data_version, snapshot) cached for the user, or None"""
+    return summary_cache.get(user_id)
+
+
+def balances_after_write(user_id, base_entry, version, category_name, sub_category, delta):
+    """Balances returned by a write that committed `version`
+
+    base_entry is the summary_cache entry read before the commit. When it
+    holds the snapshot of the previous version, the new one is derived from
+    it and the delta, and cached; otherwise the snapshot is rebuilt.
+    Returns the sub-category balance, category total and total estate.
+    """
+    if base_entry is not None and base_entry[0] == version - 1:
+        snapshot = apply_snapshot_delta(base_entry[1], category_name, sub_category, delta)
+        summary_cache.set(user_id, (version, snapshot))
+    else:
+        snapshot = get_portfolio_snapshot(user_id, data_version=version)
+
+    details = snapshot["categories"].get(category_name, {})
+    return {
+        "balance": details.get("sub_categories", {}).get(sub_category, 0),
+        "category_total": details.get("total_balance", 0),
+        "total_estate": snapshot["total_estate"],
+    }
+
+
+def mark_portfolio_changed(user_id):
+    """Bump the user's data version and invalidate the cached snapshot once
+    the current transaction commits. Rows inserted or deleted in this
+    transaction are stamped with the new version. Returns it."""
+    db.session.info.setdefault("changed_portfolios", set()).add(user_id)
+    version = bump_data_version(user_id)
+    for model in (Transactions, DeletedTransactions):
+        db.session.execute(
+            update(model)
+            .where(model.user_id == user_id, model.version.is_(None))
+            .values(version=version)
+            .execution_options(synchronize_session=False)
+        )
+    return version
+
+
+def invalidate_portfolio_cache(user_id):
+    global _invalidation_epoch
+    with _epoch_lock:
+        _invalidation_epoch += 1
+    summary_cache.discard(user_id)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_committed_portfolios(session):
+    for user_id in session.info.pop("changed_portfolios", ()):
+        invalidate_portfolio_cache(user_id)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_rolled_back_portfolios(session):
+    session.info.pop("changed_portfolios", None)
+
+
+def dashboard_view(snapshot):
+    """Categories with a positive total, as returned by /api/dashboard"""
+    portfolio_summary = {
+        category_name: details
+        for category_name, details in snapshot["categories"].items()
+        if details["total_balance"] > 0
+    }
+    return portfolio_summary, snapshot["total_estate"]
+
+
+def category_view(snapshot, category_name):
+    """Positive sub-category balances of one category and their sum"""
+    details = snapshot["categories"].get(category_name, {"sub_categories": {}})
+    category_summary = {
+        sub_category: balance
+        for sub_category, balance in details["sub_categories"].items()
+        if balance > 0
+    }
+    return category_summary, sum(category_summary.values())
+
+
+def withdraw_view(snapshot):
+    """Sub-categories with a positive balance, as offered by /api/withdraw"""
+    withdraw_categories = [
+        {"category": category_name, "sub_category": sub_category, "balance": balance}
+        for category_name, details in snapshot["categories"].items()
+        for sub_category, balance in details["sub_categories"].items()
+        if balance > 0
+    ]
+    distinct_categories = sorted({entry["category"] for entry in withdraw_categories})
+    return withdraw_categories, distinct_categories
+
+
+def snapshot_view(snapshot):
+    """Full category tree with each category's share of the total"""
+    total_estate = snapshot["total_estate"]
+    return {
+        category_name: {
+            "total_balance": details["total_balance"],
+            "share": details["total_balance"] / total_estate if total_estate else 0,
+            "sub_categories": details["sub_categories"],
+        }
+        for category_name, details in snapshot["categories"].items()
+    }
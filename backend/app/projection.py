@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import numpy as np
+from .cache_utils import BoundedTTLCache
+
+# Annual expected return and volatility per category, by risk profile. The
+# profile stands for what the user holds inside each category (e.g. euro
+# funds vs unit-linked funds in an assurance-vie).
+RETURN_ASSUMPTIONS = {
+    "prudent": {
+        "Épargne": (0.025, 0.01),
+        "Immobilier": (0.03, 0.08),
+        "Actions": (0.04, 0.10),
+        "Autres": (0.03, 0.12),
+    },
+    "équilibré": {
+        "Épargne": (0.03, 0.02),
+        "Immobilier": (0.04, 0.10),
+        "Actions": (0.06, 0.15),
+        "Autres": (0.05, 0.18),
+    },
+    "dynamique": {
+        "Épargne": (0.035, 0.03),
+        "Immobilier": (0.05, 0.12),
+        "Actions": (0.08, 0.20),
+        "Autres": (0.07, 0.25),
+    },
+}
+DEFAULT_RISK_PROFILE = "équilibré"
+DEFAULT_ASSUMPTION = (0.02, 0.05)
+
+PERCENTILES = (5, 25, 50, 75, 95)
+PROJECTION_SEED = int(os.environ.get('PROJECTION_SEED', 42))
+PROJECTION_MAX_PATHS = int(os.environ.get('PROJECTION_MAX_PATHS', 20000))
+PROJECTION_MAX_YEARS = 50
+
+# Allocation fingerprint -> projection payload
+projection_cache = BoundedTTLCache(
+    maxsize=int(os.environ.get('PROJECTION_CACHE_SIZE', 1024))
+)
+
+
+def assumptions_for(risk_profile, category_names):
+    """(mu, sigma) arrays aligned with category_names"""
+    table = RETURN_ASSUMPTIONS.get(risk_profile, RETURN_ASSUMPTIONS[DEFAULT_RISK_PROFILE])
+    pairs = [table.get(name, DEFAULT_ASSUMPTION) for name in category_names]
+    mu, sigma = np.array(pairs, dtype=np.float64).reshape(-1, 2).T
+    return mu, sigma
+
+
+def simulate(allocation, mu, sigma, years, paths, seed=PROJECTION_SEED):
+    """Total portfolio value per path and year, shape (paths, years + 1)
+
+    Each category follows a geometric Brownian motion with yearly steps;
+    every path, year and category is drawn in one standard_normal() call.
+    Column 0 is today's value.
+    """
+    rng = np.random.default_rng(seed)
+    # Worked in place: one (paths, years, categories) buffer end to end
+    growth = rng.standard_normal((paths, years, len(allocation)))
+    growth *= sigma
+    growth += mu - 0.5 * sigma ** 2
+    np.cumsum(growth, axis=1, out=growth)
+    np.exp(growth, out=growth)
+
+    totals = np.empty((paths, years + 1))
+    totals[:, 0] = allocation.sum()
+    # (paths, years, categories) @ (categories,) -> (paths, years)
+    totals[:, 1:] = growth @ allocation
+    return totals
+
+
+def percentile_bands(totals):
+    """{"p5": [...], ...}: one value per year for each percentile"""
+    bands = np.percentile(totals, PERCENTILES, axis=0)
+    return {
+        f"p{percentile}": np.round(band, 2).tolist()
+        for percentile, band in zip(PERCENTILES, bands)
+    }
+
+
+def allocation_fingerprint(risk_profile, allocation, years, paths, seed):
+    """Stable key for everything a projection depends on"""
+    raw = json.dumps(
+        [risk_profile, sorted((name, round(value, 2)) for name, value in allocation.items()),
+         years, paths, seed],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def project_portfolio(allocation, risk_profile, years=30, paths=10000, seed=PROJECTION_SEED):
+    """Percentile bands of the projected value of a {category: amount} allocation
+
+    Results are cached by allocation fingerprint, so users with the same
+    allocation and profile share one simulation.
+    """
+    fingerprint = allocation_fingerprint(risk_profile, allocation, years, paths, seed)
+    cached = projection_cache.get(fingerprint)
+    if cached is not None:
+        return cached
+
+    category_names = sorted(allocation)
+    amounts = np.array([allocation[name] for name in category_names], dtype=np.float64)
+    mu, sigma = assumptions_for(risk_profile, category_names)
+
+    result = {
+        "years": list(range(years + 1)),
+        "percentiles": percentile_bands(simulate(amounts, mu, sigma, years, paths, seed)),
+        "assumptions": {
+            name: {"return": float(name_mu), "volatility": float(name_sigma)}
+            for name, name_mu, name_sigma in zip(category_names, mu, sigma)
+        },
+    }
+    projection_cache.set(fingerprint, result)
+    return result
@@ -0,0 +1,193 @@
+import json
+from datetime import datetime
+import numpy as np
+from sqlalchemy import and_, delete, func, insert, select
+from .config import db
+from .models import Portfolios, RebalanceReports, Transactions, Users
+from .encryption_utils import monetary_crypto
+from .categories import category_registry
+
+ALLOCATION_CATEGORIES = ("Épargne", "Immobilier", "Actions", "Autres")
+
+# Target share of each category, in ALLOCATION_CATEGORIES order
+TARGET_WEIGHTS = {
+    "prudent": (0.60, 0.25, 0.10, 0.05),
+    "équilibré": (0.40, 0.30, 0.25, 0.05),
+    "dynamique": (0.20, 0.25, 0.45, 0.10),
+}
+DEFAULT_RISK_PROFILE = "équilibré"
+
+PROFILE_INDEX = {profile: index for index, profile in enumerate(TARGET_WEIGHTS)}
+TARGET_MATRIX = np.array(list(TARGET_WEIGHTS.values()), dtype=np.float64)
+
+
+def target_weights(risk_profile):
+    return TARGET_WEIGHTS.get(risk_profile, TARGET_WEIGHTS[DEFAULT_RISK_PROFILE])
+
+
+def decrypt_amounts(values):
+    """Decrypt a batch in a worker process, bypassing the memo"""
+    return monetary_crypto.decrypt_many(values, memoize=False)
+
+
+def read_chunk(after_user_id, chunk_size):
+    """Next users by id and every balance row of theirs, in one pass
+
+    Returns (user_ids, risk_profiles, rows) where rows are (user_id,
+    category_id, ciphertext) for stored balances and for ledger tails not
+    compacted yet.
+    """
+    users = db.session.execute(
+        select(Users.id, Users.risk_profile)
+        .where(Users.id > after_user_id)
+        .order_by(Users.id)
+        .limit(chunk_size)
+    ).all()
+    if not users:
+        return [], [], []
+    first, last = users[0][0], users[-1][0]
+
+    balances = db.session.execute(
+        select(
+            Portfolios.user_id,
+            Portfolios.category_id,
+            Portfolios.balance_ciphertext,
+            Portfolios.balance_encrypted,
+        )
+        .where(Portfolios.user_id.between(first, last))
+    ).all()
+    tails = db.session.execute(
+        select(
+            Transactions.user_id,
+            Transactions.category_id,
+            Transactions.amount_ciphertext,
+            Transactions.amount_encrypted,
+        )
+        .outerjoin(Portfolios, and_(
+            Portfolios.user_id == Transactions.user_id,
+            Portfolios.category_id == Transactions.category_id,
+        ))
+        .where(
+            Transactions.user_id.between(first, last),
+            Transactions.id > func.coalesce(Portfolios.checkpoint_transaction_id, 0),
+        )
+    ).all()
+
+    rows = [
+        (user_id, category_id, compact or legacy)
+        for user_id, category_id, compact, legacy in balances + tails
+        if compact or legacy
+    ]
+    return (
+        [user_id for user_id, _ in users],
+        [risk_profile for _, risk_profile in users],
+        rows,
+    )
+
+
+def _category_columns():
+    """Array mapping category_id -> column in ALLOCATION_CATEGORIES, -1 if none"""
+    ids = category_registry.get_ids(ALLOCATION_CATEGORIES)
+    columns = np.full(max(ids, default=0) + 1, -1, dtype=np.int64)
+    for category_id in ids:
+        columns[category_id] = ALLOCATION_CATEGORIES.index(
+            category_registry.get_names(category_id)[0]
+        )
+    return columns
+
+
+def allocation_drift(user_ids, risk_profiles, rows, amounts):
+    """Per-user totals, actual weights and drift from the target weights
+
+    Balances are summed into a (users, categories) matrix with np.add.at;
+    weights and drift are then whole-matrix operations. Returns (totals,
+    weights, drift) arrays, rows in user_ids order.
+    """
+    users = np.asarray(user_ids, dtype=np.int64)
+    row_users = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    row_categories = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+    amounts = np.asarray(amounts, dtype=np.float64)
+
+    columns = _category_columns()
+    known = row_categories < len(columns)
+    row_columns = np.full(len(rows), -1, dtype=np.int64)
+    row_columns[known] = columns[row_categories[known]]
+    keep = row_columns >= 0
+
+    matrix = np.zeros((len(users), len(ALLOCATION_CATEGORIES)))
+    np.add.at(
+        matrix,
+        (np.searchsorted(users, row_users[keep]), row_columns[keep]),
+        amounts[keep],
+    )
+    # A negative category balance does not count as an allocation
+    np.maximum(matrix, 0, out=matrix)
+
+    totals = matrix.sum(axis=1)
+    weights = np.divide(
+        matrix, totals[:, None], out=np.zeros_like(matrix), where=totals[:, None] > 0
+    )
+    profiles = np.fromiter(
+        (PROFILE_INDEX.get(profile, PROFILE_INDEX[DEFAULT_RISK_PROFILE])
+         for profile in risk_profiles),
+        dtype=np.int64,
+        count=len(risk_profiles),
+    )
+    drift = weights - TARGET_MATRIX[profiles]
+    return totals, weights, drift
+
+
+def write_reports(user_ids, risk_profiles, totals, weights, drift):
+    """Replace the chunk's reports; users with nothing invested get none"""
+    generated_at = datetime.utcnow()
+    invested = np.flatnonzero(totals > 0)
+    max_drift = np.abs(drift).max(axis=1)
+    ciphertexts = monetary_crypto.encrypt_many(
+        np.round(totals[invested], 2).tolist(), memoize=False
+    )
+
+    db.session.execute(
+        delete(RebalanceReports).where(RebalanceReports.user_id.in_(user_ids))
+    )
+    if len(invested):
+        db.session.execute(insert(RebalanceReports), [
+            {
+                "user_id": user_ids[index],
+                "risk_profile": risk_profiles[index],
+                "weights": json.dumps(
+                    dict(zip(ALLOCATION_CATEGORIES, np.round(weights[index], 4).tolist())),
+                    ensure_ascii=False,
+                ),
+                "max_drift": round(float(max_drift[index]), 4),
+                "total_ciphertext": ciphertext,
+                "generated_at": generated_at,
+            }
+            for index, ciphertext in zip(invested.tolist(), ciphertexts)
+        ])
+    return len(invested)
+
+
+def rebalance_view(report, risk_profile):
+    """Actual vs target weights and the amount to move per category
+
+    Targets follow the user's current risk profile, so a profile change is
+    reflected before the next nightly run. A positive amount is to invest,
+    a negative one to withdraw.
+    """
+    weights = json.loads(report.weights)
+    total = report.total
+    categories = {}
+    for category_name, target in zip(ALLOCATION_CATEGORIES, target_weights(risk_profile)):
+        actual = weights.get(category_name, 0.0)
+        categories[category_name] = {
+            "actual": actual,
+            "target": target,
+            "drift": round(actual - target, 4),
+            "amount": round((target - actual) * total, 2),
+        }
+    return {
+        "generated_at": report.generated_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "total_estate": total,
+        "max_drift": max(abs(details["drift"]) for details in categories.values()),
+        "categories": categories,
+    }
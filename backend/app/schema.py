@@ -0,0 +1,99 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+from .config import db
+
+# Columns added after tables were first created. db.create_all() only creates
+# missing tables, so existing databases receive these through ALTER TABLE.
+# Every entry must be nullable or carry a server_default.
+ADDED_COLUMNS = [
+    ("portfolios", "balance_ciphertext"),
+    ("transactions", "amount_ciphertext"),
+    ("users", "data_version"),
+    ("portfolios", "checkpoint_transaction_id"),
+    ("transactions", "version"),
+]
+
+# Statements run once, right after their column is added
+BACKFILLS = {
+    # Balances written before the ledger already include every transaction
+    ("portfolios", "checkpoint_transaction_id"): (
+        "UPDATE portfolios SET checkpoint_transaction_id = COALESCE(("
+        "SELECT MAX(t.id) FROM transactions t "
+        "WHERE t.user_id = portfolios.user_id "
+        "AND t.category_id = portfolios.category_id), 0)"
+    ),
+    # NULL marks rows not stamped yet; existing rows predate every version
+    ("transactions", "version"): "UPDATE transactions SET version = 0",
+}
+
+# Columns that were NOT NULL in earlier releases and are nullable now
+RELAXED_COLUMNS = [
+    ("portfolios", "balance_encrypted"),
+    ("transactions", "amount_encrypted"),
+]
+
+# Indexes added to existing tables
+ADDED_INDEXES = [
+    ("transactions", "ix_transactions_user_timestamp_id"),
+    ("transactions", "ix_transactions_user_category_id"),
+    ("transactions", "ix_transactions_user_version"),
+]
+
+
+def ensure_schema():
+    """Apply additive schema changes that db.create_all() does not cover"""
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as connection:
+        for table_name, column_name in ADDED_COLUMNS:
+            existing = {column["name"] for column in inspector.get_columns(table_name)}
+            if column_name in existing:
+                continue
+
+            column = db.metadata.tables[table_name].c[column_name]
+            ddl = (
+                f"ALTER TABLE {table_name} ADD COLUMN {column_name} "
+                f"{column.type.compile(dialect=connection.dialect)}"
+            )
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            connection.execute(text(ddl))
+            if (table_name, column_name) in BACKFILLS:
+                connection.execute(text(BACKFILLS[table_name, column_name]))
+            print(f"Added column {table_name}.{column_name}")
+
+        if connection.dialect.name == "postgresql":
+            for table_name, column_name in RELAXED_COLUMNS:
+                columns = {
+                    column["name"]: column
+                    for column in inspector.get_columns(table_name)
+                }
+                if not columns[column_name]["nullable"]:
+                    connection.execute(text(
+                        f"ALTER TABLE {table_name} ALTER COLUMN {column_name} DROP NOT NULL"
+                    ))
+
+    _ensure_indexes(inspector)
+
+
+def _ensure_indexes(inspector):
+    """Build missing indexes, without blocking writes on PostgreSQL"""
+    for table_name, index_name in ADDED_INDEXES:
+        existing = {index["name"] for index in inspector.get_indexes(table_name)}
+        if index_name in existing:
+            continue
+
+        table = db.metadata.tables[table_name]
+        index = next(index for index in table.indexes if index.name == index_name)
+
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        with db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        ) as connection:
+            ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+            if connection.dialect.name == "postgresql":
+                ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+            connection.execute(text(ddl))
+        print(f"Created index {index_name}")
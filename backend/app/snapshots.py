@@ -0,0 +1,199 @@
+from collections import defaultdict
+from sqlalchemy import and_, delete, insert, or_, select
+from .config import db
+from .models import PortfolioSnapshots, Portfolios, Transactions
+from .encryption_utils import monetary_crypto
+
+# A category's balance at the end of day D is its latest snapshot on or
+# before D, plus the ledger tail (transactions above the checkpoint) dated
+# on or before D. Snapshots only cover folded transactions, so they move
+# with the checkpoint in ledger.write_balances().
+
+
+def folded_flows(user_id, ranges, deleted=()):
+    """Net amount per (category_id, day) folded by one balance write
+
+    ranges maps category_id to the (previous, new) checkpoint; deleted
+    lists already-folded transactions removed by the same write.
+    """
+    flows = defaultdict(float)
+    conditions = [
+        and_(
+            Transactions.category_id == category_id,
+            Transactions.id > previous,
+            Transactions.id <= checkpoint,
+        )
+        for category_id, (previous, checkpoint) in ranges.items()
+        if checkpoint > previous
+    ]
+    if conditions:
+        rows = db.session.execute(
+            select(
+                Transactions.category_id,
+                Transactions.timestamp,
+                Transactions.amount_ciphertext,
+                Transactions.amount_encrypted,
+            )
+            .where(
+                Transactions.user_id == user_id,
+                Transactions.timestamp.isnot(None),
+                or_(*conditions),
+            )
+        ).all()
+        amounts = monetary_crypto.decrypt_many(
+            (compact or legacy for _, _, compact, legacy in rows), memoize=False
+        )
+        for (category_id, timestamp, _, _), amount in zip(rows, amounts):
+            flows[category_id, timestamp.date()] += amount
+
+    for transaction in deleted:
+        if transaction.timestamp is not None:
+            flows[transaction.category_id, transaction.timestamp.date()] -= transaction.amount
+
+    return flows
+
+
+def apply_snapshot_flows(user_id, flows):
+    """Add net flows to the snapshots of their day and of every later day
+
+    Only the category's snapshots from the earliest touched day onwards are
+    read and rewritten; a day without a snapshot gets one. The caller holds
+    the category's Portfolios row FOR UPDATE.
+    """
+    by_category = defaultdict(dict)
+    for (category_id, day), amount in flows.items():
+        if round(amount, 2):
+            by_category[category_id][day] = amount
+
+    for category_id in sorted(by_category):
+        day_flows = by_category[category_id]
+        first_day = min(day_flows)
+
+        opening = db.session.scalars(
+            select(PortfolioSnapshots.balance_ciphertext)
+            .where(
+                PortfolioSnapshots.user_id == user_id,
+                PortfolioSnapshots.category_id == category_id,
+                PortfolioSnapshots.day < first_day,
+            )
+            .order_by(PortfolioSnapshots.day.desc())
+            .limit(1)
+        ).first()
+        previous_balance = monetary_crypto.decrypt_amount(opening) if opening else 0.0
+
+        snapshots = (
+            PortfolioSnapshots.query
+            .filter(
+                PortfolioSnapshots.user_id == user_id,
+                PortfolioSnapshots.category_id == category_id,
+                PortfolioSnapshots.day >= first_day,
+            )
+            .all()
+        )
+        existing = dict(zip(
+            (snapshot.day for snapshot in snapshots),
+            zip(snapshots, monetary_crypto.decrypt_many(
+                snapshot.balance_ciphertext for snapshot in snapshots
+            )),
+        ))
+
+        offset = 0.0
+        for day in sorted(existing.keys() | day_flows.keys()):
+            offset += day_flows.get(day, 0.0)
+            if day in existing:
+                snapshot, previous_balance = existing[day]
+                snapshot.balance = round(previous_balance + offset, 2)
+            else:
+                db.session.add(PortfolioSnapshots(
+                    user_id=user_id,
+                    category_id=category_id,
+                    day=day,
+                    balance=round(previous_balance + offset, 2),
+                ))
+
+
+def closing_balance_rows(rows):
+    """Snapshot rows for (user_id, category_id, day, ciphertext) transactions
+
+    rows must be ordered by user, category and timestamp. Module-level so a
+    process pool can run it; returns dicts ready for an executemany insert.
+    """
+    amounts = monetary_crypto.decrypt_many(
+        (ciphertext for *_, ciphertext in rows), memoize=False
+    )
+    flows = {}
+    for (user_id, category_id, day, _), amount in zip(rows, amounts):
+        key = (user_id, category_id, day)
+        flows[key] = flows.get(key, 0.0) + amount
+
+    closing = []
+    current = None
+    balance = 0.0
+    for (user_id, category_id, day), amount in flows.items():
+        if (user_id, category_id) != current:
+            current = (user_id, category_id)
+            balance = 0.0
+        balance = round(balance + amount, 2)
+        closing.append((user_id, category_id, day, balance))
+
+    ciphertexts = monetary_crypto.encrypt_many(
+        (balance for *_, balance in closing), memoize=False
+    )
+    return [
+        {"user_id": user_id, "category_id": category_id, "day": day,
+         "balance_ciphertext": ciphertext}
+        for (user_id, category_id, day, _), ciphertext in zip(closing, ciphertexts)
+    ]
+
+
+def folded_transaction_rows(user_ids):
+    """Folded, dated transactions of these users, as closing_balance_rows() input
+
+    Locks the users' Portfolios rows FOR UPDATE first, in (user_id,
+    category_id) order, so no write can move a checkpoint meanwhile.
+    """
+    db.session.execute(
+        select(Portfolios.user_id)
+        .where(Portfolios.user_id.in_(user_ids))
+        .order_by(Portfolios.user_id, Portfolios.category_id)
+        .with_for_update()
+    ).all()
+
+    rows = db.session.execute(
+        select(
+            Transactions.user_id,
+            Transactions.category_id,
+            Transactions.timestamp,
+            Transactions.amount_ciphertext,
+            Transactions.amount_encrypted,
+        )
+        .join(Portfolios, and_(
+            Portfolios.user_id == Transactions.user_id,
+            Portfolios.category_id == Transactions.category_id,
+        ))
+        .where(
+            Transactions.user_id.in_(user_ids),
+            Transactions.timestamp.isnot(None),
+            Transactions.id <= Portfolios.checkpoint_transaction_id,
+        )
+        .order_by(
+            Transactions.user_id,
+            Transactions.category_id,
+            Transactions.timestamp,
+            Transactions.id,
+        )
+    ).all()
+
+    return [
+        (user_id, category_id, timestamp.date(), compact or legacy)
+        for user_id, category_id, timestamp, compact, legacy in rows
+    ]
+
+
+def replace_snapshots(user_ids, snapshot_rows):
+    """Swap the users' snapshots for freshly computed rows"""
+    db.session.execute(
+        delete(PortfolioSnapshots).where(PortfolioSnapshots.user_id.in_(user_ids))
+    )
+    if snapshot_rows:
+        db.session.execute(insert(PortfolioSnapshots), snapshot_rows)
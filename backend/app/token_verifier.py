@@ -0,0 +1,243 @@
+import base64
+import json
+import re
+import threading
+import time
+import urllib.request
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from firebase_admin import auth
+
+
+# Public certificates Google uses to sign Firebase ID tokens
+GOOGLE_CERTS_URL = (
+    "https://www.googleapis.com/robot/v1/metadata/x509/"
+    "securetoken@system.gserviceaccount.com"
+)
+
+
+def _load_public_key(key):
+    """Accept a PEM certificate, a PEM public key or a public key object"""
+    if not isinstance(key, (str, bytes)):
+        return key
+    pem = key.encode() if isinstance(key, str) else key
+    if b"BEGIN CERTIFICATE" in pem:
+        return x509.load_pem_x509_certificate(pem).public_key()
+    return serialization.load_pem_public_key(pem)
+
+
+def _parse_max_age(headers):
+    """Return the remaining cache lifetime from HTTP cache headers"""
+    match = re.search(r"max-age=(\d+)", headers.get("Cache-Control") or "")
+    if not match:
+        return None
+    max_age = int(match.group(1))
+    try:
+        max_age -= int(headers.get("Age") or 0)
+    except ValueError:
+        pass
+    return max(max_age, 0)
+
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+class GoogleCertificateSource:
+    """Fetches the Firebase signing certificates over HTTPS"""
+
+    def __init__(self, url=GOOGLE_CERTS_URL, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self):
+        """Return ({kid: public_key}, max_age_seconds)"""
+        with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+            certificates = json.loads(response.read().decode())
+            max_age = _parse_max_age(response.headers)
+        keys = {kid: _load_public_key(pem) for kid, pem in certificates.items()}
+        return keys, max_age
+
+
+class StaticKeySource:
+    """Serves a fixed key set, e.g. a locally generated key pair in tests"""
+
+    def __init__(self, keys, max_age=None):
+        self.keys = {kid: _load_public_key(key) for kid, key in keys.items()}
+        self.max_age = max_age
+
+    def fetch(self):
+        return dict(self.keys), self.max_age
+
+
+class KeyStore:
+    """In-process store of signing keys refreshed from a key source"""
+
+    def __init__(self, source, default_max_age=3600, min_refresh_interval=60):
+        self.source = source
+        self.default_max_age = default_max_age
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """Fetch the keys from the source and replace the current set"""
+        keys, max_age = self.source.fetch()
+        if max_age is None:
+            max_age = self.default_max_age
+        with self._lock:
+            self._keys = keys
+            self._last_refresh = time.time()
+            self._expires_at = self._last_refresh + max_age
+        return max_age
+
+    def get(self, kid):
+        """Return the public key for kid, refetching once if it is unknown"""
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        # Keys rotate before the old cache lifetime ends; allow a rate-limited
+        # refetch so a freshly issued token is not rejected
+        if time.time() - self._last_refresh >= self.min_refresh_interval:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Signing key refresh error: {str(e)}")
+        return self._keys.get(kid)
+
+    def start_background_refresh(self):
+        """Refresh the keys shortly before they expire in a daemon thread
+
+        Cheap once the thread runs, so it can be called on every use.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._refresh_loop, name="firebase-key-refresh", daemon=True
+            )
+            self._thread.start()
+
+    def after_fork(self):
+        """Drop the locks and thread inherited from the parent process
+
+        A lock held by one of the parent's threads at fork time would stay
+        held forever in the child. The refresh thread is started again by
+        the next start_background_refresh().
+        """
+        self._lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stop_background_refresh(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while True:
+            # Refresh at 90% of the advertised lifetime
+            delay = max(
+                (self._expires_at - time.time()) * 0.9, self.min_refresh_interval
+            )
+            if self._stop.wait(delay):
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the previous keys until the next attempt
+                print(f"Signing key refresh error: {str(e)}")
+
+
+class LocalTokenVerifier:
+    """Verifies Firebase ID tokens without leaving the process"""
+
+    def __init__(self, project_id, key_store, clock_skew=5, background_refresh=True):
+        self.project_id = project_id
+        self.issuer = f"https://securetoken.google.com/{project_id}"
+        self.key_store = key_store
+        self.clock_skew = clock_skew
+        self.background_refresh = background_refresh
+
+    def verify(self, token):
+        """Check the RS256 signature and the Firebase claims, return the claims"""
+        # Started on first use, so importing the app (CLI commands, the
+        # gunicorn master before it forks) runs no refresh thread
+        if self.background_refresh:
+            self.key_store.start_background_refresh()
+
+        try:
+            header_segment, payload_segment, signature_segment = token.split(".")
+            header = json.loads(_b64decode(header_segment))
+            claims = json.loads(_b64decode(payload_segment))
+            signature = _b64decode(signature_segment)
+        except ValueError:
+            raise auth.InvalidIdTokenError("Malformed ID token")
+
+        if header.get("alg") != "RS256":
+            raise auth.InvalidIdTokenError("Unexpected signing algorithm")
+
+        public_key = self.key_store.get(header.get("kid"))
+        if public_key is None:
+            raise auth.InvalidIdTokenError("Unknown signing key")
+
+        try:
+            public_key.verify(
+                signature,
+                f"{header_segment}.{payload_segment}".encode(),
+                padding.PKCS1v15(),
+                hashes.SHA256(),
+            )
+        except InvalidSignature:
+            raise auth.InvalidIdTokenError("Invalid token signature")
+
+        now = time.time()
+        subject = claims.get("sub")
+        if claims.get("aud") != self.project_id:
+            raise auth.InvalidIdTokenError("Invalid token audience")
+        if claims.get("iss") != self.issuer:
+            raise auth.InvalidIdTokenError("Invalid token issuer")
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise auth.InvalidIdTokenError("Invalid token subject")
+        if claims.get("iat", 0) > now + self.clock_skew:
+            raise auth.InvalidIdTokenError("Token issued in the future")
+        if claims.get("auth_time", 0) > now + self.clock_skew:
+            raise auth.InvalidIdTokenError("Invalid token auth_time")
+        if claims.get("exp", 0) <= now - self.clock_skew:
+            raise auth.ExpiredIdTokenError("Token expired", None)
+
+        claims["uid"] = subject
+        return claims
+
+
+# Set by configure_local_verifier() when local verification is enabled
+local_verifier = None
+
+
+def configure_local_verifier(project_id, key_source=None, background_refresh=True):
+    """Preload the signing keys and switch token checks to local verification
+
+    With background_refresh, the keys are refreshed in a thread started by
+    the first verification.
+    """
+    global local_verifier
+    key_store = KeyStore(key_source or GoogleCertificateSource())
+    key_store.refresh()
+    local_verifier = LocalTokenVerifier(
+        project_id, key_store, background_refresh=background_refresh
+    )
+    return local_verifier
+
+
+def get_local_verifier():
+    return local_verifier
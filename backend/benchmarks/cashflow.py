@@ -0,0 +1,98 @@
+"""Time the cash-flow and time-series analytics on a synthetic history
+
+Usage, from the backend directory:
+    python benchmarks/cashflow.py --transactions 100000
+
+No database is queried: the synthetic transactions are encrypted and then
+decrypted in one batch like the endpoints do, and the pandas aggregations
+run on the resulting frame. Importing the app still sets up its database
+engine, so without DATABASE_URL a throwaway SQLite URL is used.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Without MONETARY_ENCRYPTION_KEYS, use a throwaway development key
+os.environ.setdefault("FLASK_DEBUG", "1")
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "helpinvest-benchmark.db"),
+)
+
+import numpy as np
+import pandas as pd
+from app.analytics import (
+    balance_timeseries,
+    cashflow_matrix,
+    cashflow_payload,
+    timeseries_payload,
+)
+from app.encryption_utils import monetary_crypto
+
+
+def synthetic_frame(transactions, categories, years, seed):
+    """Random dated flows shaped like load_transaction_frame()"""
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp("2025-01-01")
+    seconds = rng.integers(0, years * 365 * 86400, size=transactions)
+    timestamps = end - pd.to_timedelta(seconds, unit="s")
+    category_ids = rng.integers(1, categories + 1, size=transactions)
+    # Mostly deposits, some withdrawals, rounded to cents
+    amounts = np.round(rng.lognormal(5, 1, size=transactions), 2)
+    amounts[rng.random(transactions) < 0.2] *= -1
+
+    frame = pd.DataFrame(
+        {"category_id": category_ids, "amount": amounts},
+        index=pd.DatetimeIndex(timestamps, name="timestamp"),
+    )
+    frame["category"] = ("Catégorie " + frame["category_id"].astype(str)).astype("category")
+    return frame.sort_index(kind="stable")
+
+
+def timed(label, function, repeat):
+    """Run function `repeat` times, print the best time, return its result"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    print(f"{label:<32} {best * 1000:9.1f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transactions", type=int, default=100_000)
+    parser.add_argument("--categories", type=int, default=12)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    frame = synthetic_frame(args.transactions, args.categories, args.years, args.seed)
+    print(f"{args.transactions} transactions, {args.categories} categories, {args.years} years")
+
+    ciphertexts = monetary_crypto.encrypt_many(frame["amount"], memoize=False)
+    timed(
+        "batch decrypt",
+        lambda: monetary_crypto.decrypt_many(ciphertexts, memoize=False),
+        args.repeat,
+    )
+    timed(
+        "cashflow matrix + payload",
+        lambda: cashflow_payload(cashflow_matrix(frame)),
+        args.repeat,
+    )
+    for granularity in ("day", "week", "month"):
+        timed(
+            f"timeseries ({granularity})",
+            lambda: timeseries_payload(balance_timeseries(frame, granularity)),
+            args.repeat,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Measure throughput and latency of a running API under concurrent load
+
+Usage, against a server that is already running:
+    python benchmarks/load_test.py http://localhost:5001/ --concurrency 32
+    python benchmarks/load_test.py http://localhost:5001/api/dashboard \\
+        --header "Authorization: Bearer $ID_TOKEN" --duration 30
+
+To compare serving modes, run it once against the development server
+(python -m flask --app backend.app.main run) and once against gunicorn
+(gunicorn -c backend/gunicorn.conf.py backend.app.main:app), with the same
+database and arguments. Only the standard library is used.
+"""
+import argparse
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+def worker(url, headers, deadline, latencies, errors, lock):
+    """Send requests back to back until the deadline"""
+    own_latencies = []
+    own_errors = 0
+    while time.perf_counter() < deadline:
+        request = urllib.request.Request(url, headers=headers)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+            own_latencies.append(time.perf_counter() - started)
+        except urllib.error.HTTPError as e:
+            # A 304 is a successful conditional request
+            if e.code == 304:
+                own_latencies.append(time.perf_counter() - started)
+            else:
+                own_errors += 1
+        except Exception:
+            own_errors += 1
+
+    with lock:
+        latencies.extend(own_latencies)
+        errors.append(own_errors)
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("url")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--header", action="append", default=[],
+                        help='"Name: value", may be repeated')
+    args = parser.parse_args()
+
+    headers = dict(
+        (name.strip(), value.strip())
+        for name, _, value in (header.partition(":") for header in args.header)
+    )
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(
+            target=worker, args=(args.url, headers, deadline, latencies, errors, lock)
+        )
+        for _ in range(args.concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.url}: {args.concurrency} clients, {elapsed:.1f} s")
+    print(f"requests   {len(latencies)} ok, {sum(errors)} failed")
+    if not latencies:
+        return
+    latencies.sort()
+    print(f"throughput {len(latencies) / elapsed:10.1f} req/s")
+    print(f"latency    p50 {statistics.median(latencies) * 1000:8.1f} ms"
+          f"   p95 {percentile(latencies, 0.95) * 1000:8.1f} ms"
+          f"   p99 {percentile(latencies, 0.99) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
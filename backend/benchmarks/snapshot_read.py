@@ -0,0 +1,143 @@
+"""Compare the ORM and Core read paths behind the portfolio snapshot
+
+Usage, from the backend directory:
+    python benchmarks/snapshot_read.py --repeat 500
+
+Runs against DATABASE_URL, or a throwaway SQLite file when it is unset. A
+benchmark user is created with a balance in every sub-category, then each
+read path is timed and traced with tracemalloc. The session is removed
+after every call, as at the end of a request, so each call starts with an
+empty identity map.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Without MONETARY_ENCRYPTION_KEYS, use a throwaway development key
+os.environ.setdefault("FLASK_DEBUG", "1")
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "helpinvest-benchmark.db"),
+)
+
+from app.main import app
+from app.config import db
+from app.models import Categories, Portfolios, Users
+from app.encryption_utils import monetary_crypto
+from app.portfolio import WRITE_MODE, build_portfolio_snapshot, tail_amounts
+
+BENCHMARK_UID = "benchmark-snapshot-read"
+
+
+def orm_snapshot(user_id):
+    """The previous read path: Portfolios and Categories objects, joined"""
+    portfolio_data = (
+        db.session.query(Portfolios, Categories)
+        .join(Categories, Portfolios.category_id == Categories.id)
+        .filter(Portfolios.user_id == user_id)
+        .all()
+    )
+    balances = monetary_crypto.decrypt_many(
+        portfolio.stored_balance for portfolio, _ in portfolio_data
+    )
+    tails = tail_amounts(user_id) if WRITE_MODE == "ledger" else {}
+
+    total_estate = 0
+    categories = {}
+    for (portfolio, category), balance in zip(portfolio_data, balances):
+        balance = round(balance + tails.get(portfolio.category_id, 0.0), 2)
+        if balance == 0:
+            continue
+        total_estate += balance
+        details = categories.setdefault(category.category_name, {
+            "total_balance": 0,
+            "sub_categories": {},
+        })
+        details["total_balance"] += balance
+        sub_categories = details["sub_categories"]
+        sub_categories[category.sub_category] = (
+            sub_categories.get(category.sub_category, 0) + balance
+        )
+    for details in categories.values():
+        details["total_balance"] = round(details["total_balance"], 2)
+    return {"categories": categories, "total_estate": round(total_estate, 2)}
+
+
+def benchmark_user():
+    """The benchmark user, with a balance in every sub-category"""
+    user = Users.query.filter_by(firebase_uid=BENCHMARK_UID).first()
+    if user is None:
+        user = Users(firebase_uid=BENCHMARK_UID, email=f"{BENCHMARK_UID}@example.com")
+        db.session.add(user)
+        db.session.flush()
+        for index, category in enumerate(Categories.query.order_by(Categories.id)):
+            portfolio = Portfolios(user_id=user.id, category_id=category.id)
+            portfolio.balance = 1000 + index * 250.5
+            db.session.add(portfolio)
+        db.session.commit()
+    user_id = user.id
+    db.session.remove()
+    return user_id
+
+
+def measure(label, function, user_id, repeat):
+    """Print the median latency of function(user_id) and its memory use
+
+    Blocks are the allocations still alive when the call returns, before
+    the session is removed: mostly the identity map and its row state.
+    """
+    # Warm up statement caches and the decrypt memo
+    function(user_id)
+    db.session.remove()
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(user_id)
+        db.session.remove()
+        timings.append(time.perf_counter() - started)
+
+    # Snapshots are slow to take, so fewer traced calls
+    traced = min(repeat, 50)
+    tracemalloc.start()
+    blocks = 0
+    peak = 0
+    for _ in range(traced):
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        function(user_id)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        after = tracemalloc.take_snapshot()
+        blocks += sum(
+            max(stat.count_diff, 0) for stat in after.compare_to(before, "filename")
+        )
+        db.session.remove()
+    tracemalloc.stop()
+
+    print(
+        f"{label:<6} {statistics.median(timings) * 1000:8.3f} ms"
+        f" {blocks / traced:10.0f} blocks {peak / 1024:9.1f} KiB peak"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    with app.app_context():
+        user_id = benchmark_user()
+        assert orm_snapshot(user_id) == build_portfolio_snapshot(user_id)
+        db.session.remove()
+
+        measure("orm", orm_snapshot, user_id, args.repeat)
+        measure("core", build_portfolio_snapshot, user_id, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
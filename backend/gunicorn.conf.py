@@ -0,0 +1,80 @@
+# Production server settings, from the repository root:
+#     gunicorn -c backend/gunicorn.conf.py backend.app.main:app
+import importlib
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# "gthread" (default): each worker serves GUNICORN_THREADS requests at once,
+# and each open /api/events stream holds one of those threads.
+# "gevent": one greenlet per request, up to GUNICORN_WORKER_CONNECTIONS per
+# worker; requires `pip install gevent psycogreen`. Prefer it when many
+# clients keep an /api/events stream open: streams hold no database
+# connection, while API calls beyond the pool wait up to DB_POOL_TIMEOUT.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Database connections of one worker: its pool (see config.py) and the events
+# broker listener. A gthread request uses one connection at most, so the pool
+# defaults to one per thread. Set before the app import.
+if worker_class == 'gthread':
+    os.environ.setdefault('DB_POOL_SIZE', str(threads))
+    os.environ.setdefault('DB_MAX_OVERFLOW', '0')
+worker_db_connections = (
+    int(os.environ.get('DB_POOL_SIZE', 5)) + int(os.environ.get('DB_MAX_OVERFLOW', 10)) + 1
+)
+
+# Connections all workers together may open: below PostgreSQL's
+# max_connections (100 by default), leaving room for maintenance commands
+db_max_connections = int(os.environ.get('DB_MAX_CONNECTIONS', 80))
+workers = int(os.environ.get('GUNICORN_WORKERS', max(
+    min(multiprocessing.cpu_count() * 2 + 1, db_max_connections // worker_db_connections),
+    1,
+)))
+if workers * worker_db_connections > db_max_connections:
+    raise RuntimeError(
+        f"GUNICORN_WORKERS={workers} workers of {worker_db_connections} database "
+        f"connections each exceed DB_MAX_CONNECTIONS={db_max_connections}; lower "
+        f"GUNICORN_WORKERS or the DB_POOL_* sizes, or raise DB_MAX_CONNECTIONS "
+        f"along with PostgreSQL's max_connections"
+    )
+
+# Streams beyond this answer 503, so that API calls always find a thread:
+# half the threads of a gthread worker by default
+if worker_class == 'gthread':
+    os.environ.setdefault('EVENTS_MAX_STREAMS', str(max(threads // 2, 1)))
+
+# /api/events subscribers connect to any worker: with more than one, balance
+# events must go through PostgreSQL to reach them. Set before the app import.
+if workers > 1:
+    os.environ.setdefault('EVENTS_BROKER', 'postgres')
+    if os.environ['EVENTS_BROKER'] != 'postgres':
+        raise RuntimeError(
+            f"EVENTS_BROKER={os.environ['EVENTS_BROKER']} only reaches subscribers of "
+            f"the worker that handled the write; use EVENTS_BROKER=postgres with "
+            f"GUNICORN_WORKERS={workers}"
+        )
+
+# Import the app (schema checks, category registry, signing keys) once in
+# the master; workers are forked from it and share its memory pages
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Without this, each query blocks every greenlet of the worker
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    # The module named in the app URI was imported by the master (preload)
+    module_name = server.app.app_uri.partition(":")[0]
+    importlib.import_module(module_name).after_fork()